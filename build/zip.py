@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
 import os
 import subprocess
 import sys
-import zipfile
+import tempfile
+import time
+
+sys.path.append(
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'script'))
+
+from lib.zip_writer import add_to_zip, digest_file_path, parse_compression, \
+                            walk_files, walk_tree, write_zips
 
 EXTENSIONS_TO_SKIP = [
   '.pdb',
@@ -71,47 +80,202 @@ def execute(argv):
     print(e.output)
     raise e
 
-def main(argv):
-  dist_zip, runtime_deps, target_cpu, _, flatten_val, flatten_relative_to = argv
-  should_flatten = flatten_val == "true"
-  dist_files = set()
-  with open(runtime_deps) as f:
+def zip_members(dist_files, should_flatten, flatten_relative_to, walked,
+                tree=False):
+  """Return the (path, arcname) pairs to write for |dist_files|. With
+  |tree|, directories and symlinks are included like 'zip -r -y' includes
+  them. |walked| caches what was found in each directory, for the other
+  archives."""
+  members = []
+  for dep in dist_files:
+    if os.path.isdir(dep):
+      if (dep, tree) not in walked:
+        walked[dep, tree] = walk_tree(dep) if tree else walk_files(dep)
+      members += [(path, path) for path in walked[dep, tree]]
+    else:
+      basename = os.path.basename(dep)
+      dirname = os.path.dirname(dep)
+      arcname = (
+        os.path.join(dirname, 'chrome-sandbox')
+        if basename == 'chrome_sandbox'
+        else dep
+      )
+      name_to_write = arcname
+      if should_flatten:
+        if flatten_relative_to:
+          if name_to_write.startswith(flatten_relative_to):
+            name_to_write = name_to_write[len(flatten_relative_to):]
+          else:
+            name_to_write = os.path.basename(arcname)
+        else:
+          name_to_write = os.path.basename(arcname)
+      members.append((dep, name_to_write))
+  return members
+
+def read_dist_files(runtime_deps, dist_zip, target_cpu):
+  # A dict rather than a set keeps the order of the runtime deps, so that
+  # the same inputs always give the same archive.
+  dist_files = {}
+  with open(runtime_deps, encoding='utf-8') as f:
     for dep in f.readlines():
       dep = dep.strip()
       if not skip_path(dep, dist_zip, target_cpu):
-        dist_files.add(dep)
-  if sys.platform == 'darwin' and not should_flatten:
-    execute(['zip', '-r', '-y', dist_zip] + list(dist_files))
-  else:
-    with zipfile.ZipFile(
-      dist_zip, 'w', zipfile.ZIP_DEFLATED, allowZip64=True
-    ) as z:
-      for dep in dist_files:
-        if os.path.isdir(dep):
-          for root, _, files in os.walk(dep):
-            for filename in files:
-              z.write(os.path.join(root, filename))
-        else:
-          basename = os.path.basename(dep)
-          dirname = os.path.dirname(dep)
-          arcname = (
-            os.path.join(dirname, 'chrome-sandbox')
-            if basename == 'chrome_sandbox'
-            else dep
-          )
-          name_to_write = arcname
-          if should_flatten:
-            if flatten_relative_to:
-              if name_to_write.startswith(flatten_relative_to):
-                name_to_write = name_to_write[len(flatten_relative_to):]
-              else:
-                name_to_write = os.path.basename(arcname)
-            else:
-              name_to_write = os.path.basename(arcname)
-          z.write(
-            dep,
-            name_to_write,
-          )
+        dist_files[dep] = None
+  return dist_files
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(
+    description='Zip up runtime deps',
+    usage='%(prog)s dist_zip runtime_deps target_cpu target_os flatten '
+          'flatten_relative_to [--previous-zip PREVIOUS_ZIP] '
+          '[--deterministic] [--compression POLICY] [--benchmark POLICY]\n'
+          '       %(prog)s --outputs OUTPUTS [--deterministic] '
+          '[--compression POLICY] [--benchmark POLICY]\n'
+          '       %(prog)s --add ZIP FILE [FILE ...]')
+  parser.add_argument('dist_zip', nargs='?')
+  parser.add_argument('runtime_deps', nargs='?')
+  parser.add_argument('target_cpu', nargs='?')
+  parser.add_argument('target_os', nargs='?')
+  parser.add_argument('flatten', nargs='?')
+  parser.add_argument('flatten_relative_to', nargs='?')
+  parser.add_argument('--previous-zip',
+                      help='archive to copy the members whose input did not '
+                           'change from, instead of compressing them again. '
+                           'May be the archive being replaced.')
+  parser.add_argument('--outputs',
+                      help='JSON file describing several archives to write '
+                           'in one pass: {"target_cpu": ..., "outputs": '
+                           '[{"zip", "runtime_deps", "flatten", '
+                           '"flatten_relative_to", "previous_zip"}, ...]}. '
+                           'Inputs shared by the archives are compressed '
+                           'once.')
+  parser.add_argument('--deterministic', action='store_true',
+                      help='give every member the same timestamp and '
+                           'normalized permissions, sort them by name and '
+                           'leave out extra fields, so that the same inputs '
+                           'always give the same archive')
+  parser.add_argument('--compression', type=parse_compression,
+                      help='how to compress members by name, as comma '
+                           'separated PATTERN=METHOD[:LEVEL] rules, e.g. '
+                           '"*.pak=store,*.dat=deflate:9". METHOD is store, '
+                           'deflate, bzip2 or lzma; members that match no '
+                           'rule are deflated.')
+  parser.add_argument('--add', nargs='+', metavar=('ZIP', 'FILE'),
+                      help='add FILEs to the existing archive ZIP under '
+                           'their paths, rewriting it as a deterministic '
+                           'archive. Takes no other arguments.')
+  parser.add_argument('--benchmark', action='append', metavar='POLICY',
+                      help='instead of writing the archives, write them '
+                           'with the default compression and with every '
+                           'policy given (like --compression) and report '
+                           'their size and the CPU time taken. May be given '
+                           'more than once.')
+  args = parser.parse_args(argv)
+  for policy in args.benchmark or []:
+    try:
+      parse_compression(policy)
+    except ValueError as e:
+      parser.error(str(e))
+  if args.add is not None:
+    if len(args.add) < 2:
+      parser.error('--add expects an archive and the files to add to it')
+    if args.dist_zip is not None or args.outputs is not None:
+      parser.error('--add does not take any other arguments')
+    return args
+  if args.outputs is None and args.flatten_relative_to is None:
+    parser.error('expected six arguments or --outputs')
+  if args.outputs is not None and args.dist_zip is not None:
+    parser.error('--outputs does not take any other arguments')
+  return args
+
+def read_outputs(args):
+  """Return the archives to write as dicts with the 'zip',
+  'runtime_deps', 'flatten', 'flatten_relative_to' and 'previous_zip' of
+  each, and the target CPU."""
+  if args.outputs is None:
+    return [{
+      'zip': args.dist_zip,
+      'runtime_deps': args.runtime_deps,
+      'flatten': args.flatten == "true",
+      'flatten_relative_to': args.flatten_relative_to,
+      'previous_zip': args.previous_zip,
+    }], args.target_cpu
+  with open(args.outputs, encoding='utf-8') as f:
+    spec = json.load(f)
+  return [{
+    'zip': output['zip'],
+    'runtime_deps': output['runtime_deps'],
+    'flatten': output.get('flatten') in (True, "true"),
+    'flatten_relative_to': output.get('flatten_relative_to') or False,
+    'previous_zip': output.get('previous_zip'),
+  } for output in spec['outputs']], spec['target_cpu']
+
+def benchmark(to_write, policies, deterministic, symlinks):
+  """Write the archives in |to_write| once with every compression policy
+  and print their total size against the time spent compressing them."""
+  input_size = sum(
+    os.path.getsize(path)
+    for path in {path for _, members, _ in to_write for path, _ in members}
+    if os.path.isfile(path)
+  )
+  print("{:>14}  {:>6}  {:>9}  {:>9}  {}".format(
+    "size", "ratio", "cpu", "wall", "policy"))
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for policy in [''] + policies:
+      outputs = [
+        (os.path.join(tmp_dir, '{}.zip'.format(i)), members, None)
+        for i, (_, members, _) in enumerate(to_write)
+      ]
+      started_cpu = time.process_time()
+      started = time.monotonic()
+      write_zips(outputs, deterministic=deterministic, symlinks=symlinks,
+                 compression=parse_compression(policy))
+      cpu = time.process_time() - started_cpu
+      wall = time.monotonic() - started
+      size = sum(os.path.getsize(zip_path) for zip_path, _, _ in outputs)
+      print("{:>14,}  {:>6.1%}  {:>8.2f}s  {:>8.2f}s  {}".format(
+        size, size / max(input_size, 1), cpu, wall, policy or 'deflate'))
+      for zip_path, _, _ in outputs:
+        os.remove(zip_path)
+
+def main(argv):
+  args = parse_args(argv)
+  if args.add is not None:
+    add_to_zip(args.add[0], [(path, path) for path in args.add[1:]])
+    return
+  outputs, target_cpu = read_outputs(args)
+  to_write = []
+  walked = {}
+  # 'zip -y' keeps the symlinks in app bundles and frameworks. The
+  # deterministic writer stores them itself.
+  tree = sys.platform == 'darwin'
+  for output in outputs:
+    dist_zip = output['zip']
+    dist_files = read_dist_files(output['runtime_deps'], dist_zip, target_cpu)
+    if tree and not output['flatten'] and not args.deterministic \
+       and args.compression is None and not args.benchmark:
+      # The digests recorded by an earlier write_zips() would not describe
+      # this archive.
+      if os.path.exists(digest_file_path(dist_zip)):
+        os.remove(digest_file_path(dist_zip))
+      execute(['zip', '-r', '-y', dist_zip] + list(dist_files))
+    else:
+      members = zip_members(dist_files, output['flatten'],
+                            output['flatten_relative_to'], walked,
+                            tree and not output['flatten'])
+      if tree and output['flatten']:
+        # Flattened archives hold the files that symlinks point to.
+        members = [(os.path.realpath(path), arcname)
+                   for path, arcname in members]
+      to_write.append((dist_zip, members, output['previous_zip']))
+  if args.benchmark:
+    benchmark(to_write, args.benchmark, args.deterministic, tree)
+    return
+  reused = write_zips(to_write, deterministic=args.deterministic,
+                      symlinks=tree, compression=args.compression)
+  for (dist_zip, _, _), count in zip(to_write, reused):
+    if count:
+      print("Reused {} unchanged members in {}".format(count, dist_zip))
 
 if __name__ == '__main__':
   sys.exit(main(sys.argv[1:]))
@@ -3,7 +3,11 @@
 import os
 import subprocess
 import sys
-import zipfile
+
+sys.path.append(
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'script'))
+
+from lib.zip_writer import write_zip
 
 def execute(argv):
   try:
@@ -34,14 +38,17 @@ def main(argv):
   base_path_libcxxabi = os.path.join(out_dir, 'obj/buildtools/third_party/libc++abi')
   object_files_libcxx = get_object_files(base_path_libcxx, 'libc++.a')
   object_files_libcxxabi = get_object_files(base_path_libcxxabi, 'libc++abi.a')
-  with zipfile.ZipFile(
-      dist_zip, 'w', zipfile.ZIP_DEFLATED, allowZip64=True
-    ) as z:
-      object_files_libcxx.sort()
-      for object_file in object_files_libcxx:
-        z.write(object_file, os.path.relpath(object_file, base_path_libcxx))
-      for object_file in object_files_libcxxabi:
-        z.write(object_file, os.path.relpath(object_file, base_path_libcxxabi))
+  write_zip(
+    dist_zip,
+    [
+      (object_file, os.path.relpath(object_file, base_path_libcxx))
+      for object_file in object_files_libcxx
+    ] + [
+      (object_file, os.path.relpath(object_file, base_path_libcxxabi))
+      for object_file in object_files_libcxxabi
+    ],
+    deterministic=True,
+  )
 
 if __name__ == '__main__':
   sys.exit(main(sys.argv[1:]))
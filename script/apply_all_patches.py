@@ -1,44 +1,221 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import sys
+import tempfile
+import time
 import warnings
 
 from lib import git
-from lib.patches import patch_from_dir
+from lib.patches import patch_lines_from_dir, patch_series_digest
 
-THREEWAY = "ELECTRON_USE_THREE_WAY_MERGE_FOR_PATCHES" in os.environ
+# Set to 'fallback' to only use a 3-way merge for patches that fail without.
+THREEWAY = os.environ.get("ELECTRON_USE_THREE_WAY_MERGE_FOR_PATCHES")
+if THREEWAY != git.THREEWAY_FALLBACK:
+  THREEWAY = THREEWAY is not None
 
-def apply_patches(target):
+def write_message(output, message):
+  if output is None:
+    sys.stdout.write(message)
+  else:
+    output.write(message.encode('utf-8'))
+
+def apply_patches(target, output=None, cache=False, engine='am',
+                  report=None):
   repo = target.get('repo')
   if not os.path.exists(repo):
     warnings.warn(f'repo not found: {repo}')
     return
   patch_dir = target.get('patch_dir')
-  git.import_patches(
-    committer_email="scripts@electron",
-    committer_name="Electron Scripts",
-    patch_data=patch_from_dir(patch_dir),
-    repo=repo,
-    threeway=THREEWAY,
-  )
-
-def apply_config(config):
-  for target in config:
-    apply_patches(target)
+  fallbacks = [] if THREEWAY == git.THREEWAY_FALLBACK else None
+  try:
+    restored = git.import_patches(
+      cache_key=patch_series_digest(patch_dir) if cache else None,
+      committer_email="scripts@electron",
+      committer_name="Electron Scripts",
+      engine=engine,
+      fallbacks=fallbacks,
+      patch_data=patch_lines_from_dir(patch_dir),
+      patch_dir=patch_dir,
+      repo=repo,
+      report=report,
+      threeway=THREEWAY,
+      output=output,
+    )
+  except Exception as e:
+    if report is not None:
+      report['error'] = str(e)
+    raise
+  if restored:
+    write_message(output, f'Restored cached patched tree for {repo}\n')
+  if fallbacks:
+    write_message(output, f'{len(fallbacks)} patches in {repo} needed a '
+                          f'3-way merge:\n')
+    for patch in fallbacks:
+      write_message(output, f'  {patch}\n')
+
+def log_file_name(repo):
+  return repo.replace('/', '_').replace(os.sep, '_') + '.log'
+
+def apply_patches_logged(target, log_dir, cache, engine, report=None):
+  """Apply a single target, capturing git's output in a per-repo log.
+  Returns a (log, error) tuple; |error| is None on success."""
+  error = None
+  with tempfile.TemporaryFile() as log:
+    try:
+      apply_patches(target, output=log, cache=cache, engine=engine,
+                    report=report)
+    except Exception as e:  # pylint: disable=broad-except
+      error = e
+    log.seek(0)
+    log_data = log.read().decode('utf-8', errors='replace')
+  if log_dir is not None:
+    log_path = os.path.join(log_dir, log_file_name(target.get('repo')))
+    with open(log_path, 'w', encoding='utf-8') as f:
+      f.write(log_data)
+  return log_data, error
+
+def new_report(reports, target):
+  """Add an entry for |target| to |reports|, unless no report was asked for."""
+  if reports is None:
+    return None
+  report = {'repo': target.get('repo'), 'patch_dir': target.get('patch_dir')}
+  reports.append(report)
+  return report
+
+def apply_config_parallel(config, jobs, log_dir=None, cache=False,
+                          engine='am', reports=None):
+  """Apply every target in |config| concurrently, one worker per repo and at
+  most |jobs| at a time. Each repo's git output is kept together rather than
+  interleaved, and all failures are reported once every repo has finished."""
+  if log_dir is not None:
+    os.makedirs(log_dir, exist_ok=True)
+  failures = []
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = [
+      (target, executor.submit(apply_patches_logged, target, log_dir, cache,
+                               engine, new_report(reports, target)))
+      for target in config
+    ]
+    for target, future in futures:
+      repo = target.get('repo')
+      log_data, error = future.result()
+      status = 'FAILED' if error is not None else 'done'
+      sys.stdout.write(f'==> {repo}: {status}\n{log_data}')
+      sys.stdout.flush()
+      if error is not None:
+        failures.append((target, error))
+  return failures
+
+def apply_config(config, jobs=1, log_dir=None, cache=False, engine='am',
+                 reports=None):
+  if jobs == 1 and log_dir is None:
+    for target in config:
+      apply_patches(target, cache=cache, engine=engine,
+                    report=new_report(reports, target))
+    return
+  failures = apply_config_parallel(config, jobs, log_dir, cache, engine,
+                                   reports)
+  if failures:
+    sys.stderr.write(
+      f"Failed to apply patches in {len(failures)} of {len(config)} repos:\n"
+    )
+    for target, error in failures:
+      sys.stderr.write(
+        f"-- {target.get('repo')} ({target.get('patch_dir')}): {error}\n"
+      )
+    if log_dir is not None:
+      sys.stderr.write(f"Per-repo logs are in {log_dir}\n")
+    sys.exit(1)
 
 def parse_args():
   parser = argparse.ArgumentParser(description='Apply Electron patches')
   parser.add_argument('config', nargs='+',
                       type=argparse.FileType('r'),
                       help='patches\' config(s) in the JSON format')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='number of repos to patch concurrently. Pass 0 '
+                           'to use one worker per repo.')
+  parser.add_argument('--log-dir',
+                      help='directory in which to keep a git log per repo')
+  parser.add_argument('--cache', action='store_true',
+                      help='reuse the previously patched commit when neither '
+                           'the upstream HEAD nor the patch series changed')
+  parser.add_argument('--engine', choices=list(git.IMPORT_ENGINES),
+                      default='am',
+                      help='how to create the patch commits')
+  parser.add_argument('--report',
+                      help='write the time taken by each repo and patch, and '
+                           'the size of each patch, to this JSON file')
+  parser.add_argument('--report-top', type=int, default=10,
+                      help='number of patches to list in the summary printed '
+                           'with --report')
   return parser.parse_args()
 
 
+def format_patch_stats(patch):
+  binary = f", {patch['binary_files']} binary" if patch['binary_files'] else ''
+  return (f"{patch['files']} files, {patch['hunks']} hunks{binary}, "
+          f"{patch['bytes'] / 1024:.1f} KiB")
+
+def print_report_summary(reports, top):
+  """Print the slowest repos, and the slowest and largest patches."""
+  print('Slowest repos:')
+  for report in sorted(reports, key=lambda r: -r.get('seconds', 0)):
+    note = ' (from cache)' if report.get('restored_from_cache') else ''
+    if 'error' in report:
+      note = ' (failed)'
+    print(f"  {report.get('seconds', 0):8.2f}s  {report['repo']}: "
+          f"{len(report.get('patches', []))} patches{note}")
+  fallbacks = [
+    (report['repo'], patch)
+    for report in reports
+    for patch in report.get('threeway_fallbacks', [])
+  ]
+  if fallbacks:
+    print(f'{len(fallbacks)} patches needed a 3-way merge:')
+    for repo, patch in fallbacks:
+      print(f'  {repo}: {patch}')
+  patches = [
+    (report['repo'], patch)
+    for report in reports
+    for patch in report.get('patches', [])
+  ]
+  timed = [(repo, p) for repo, p in patches if p['seconds'] is not None]
+  print(f'Slowest {min(top, len(timed))} patches:')
+  for repo, patch in sorted(timed, key=lambda rp: -rp[1]['seconds'])[:top]:
+    print(f"  {patch['seconds']:8.2f}s  {repo}: "
+          f"{patch['patch'] or patch['subject']} ({format_patch_stats(patch)})")
+  print(f'Largest {min(top, len(patches))} patches:')
+  for repo, patch in sorted(patches, key=lambda rp: -rp[1]['bytes'])[:top]:
+    print(f"  {patch['bytes'] / 1024:8.1f} KiB  {repo}: "
+          f"{patch['patch'] or patch['subject']} ({format_patch_stats(patch)})")
+
+def write_report(path, reports, seconds, top):
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump({'seconds': seconds, 'repos': reports}, f, indent=2)
+    f.write('\n')
+  print_report_summary(reports, top)
+  print(f'Wrote patch timing report to {path}')
+
+
 def main():
-  for config_json in parse_args().config:
-    apply_config(json.load(config_json))
+  args = parse_args()
+  reports = [] if args.report else None
+  started = time.monotonic()
+  try:
+    for config_json in args.config:
+      config = json.load(config_json)
+      jobs = args.jobs if args.jobs > 0 else max(len(config), 1)
+      apply_config(config, jobs=jobs, log_dir=args.log_dir, cache=args.cache,
+                   engine=args.engine, reports=reports)
+  finally:
+    if reports is not None:
+      write_report(args.report, reports, time.monotonic() - started,
+                   args.report_top)
 
 
 if __name__ == '__main__':
@@ -6,7 +6,7 @@ const patchExportFnPath = path.resolve(__dirname, 'export_all_patches.py');
 const configPath = path.resolve(__dirname, '..', 'patches', 'config.json');
 
 // Re-export all the patches to check if there were changes.
-const proc = spawnSync('python3', [patchExportFnPath, configPath, '--dry-run'], {
+const proc = spawnSync('python3', [patchExportFnPath, configPath, '--dry-run', '--jobs', '0'], {
   cwd: srcPath
 });
 
@@ -1,29 +1,55 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import sys
+import traceback
 import warnings
 
 from lib import git
 
 
-def export_patches(target, dry_run):
+def export_patches(target, dry_run, only_changed=False, use_cache=False):
   repo = target.get('repo')
   if not os.path.exists(repo):
     warnings.warn(f'repo not found: {repo}')
-    return
-  git.export_patches(
+    return None
+  return git.export_patches(
     dry_run=dry_run,
     grep=target.get('grep'),
+    only_changed=only_changed,
     out_dir=target.get('patch_dir'),
-    repo=repo
+    repo=repo,
+    use_cache=use_cache,
   )
 
 
-def export_config(config, dry_run):
-  for target in config:
-    export_patches(target, dry_run)
+def export_target(target, dry_run, only_changed, use_cache):
+  """Export a single target, returning its report entry: the stale patches
+  in dry-run mode, or the error that stopped the export."""
+  result = {'repo': target.get('repo'), 'patch_dir': target.get('patch_dir')}
+  try:
+    stale = export_patches(target, dry_run, only_changed, use_cache)
+    if dry_run:
+      result['stale'] = stale or []
+  except Exception as e:  # pylint: disable=broad-except
+    traceback.print_exc()
+    result['error'] = str(e)
+  return result
+
+
+def export_config(config, dry_run, only_changed=False, use_cache=False,
+                  jobs=1):
+  """Export every target in |config|, at most |jobs| at a time. Every target
+  is exported (or checked) even if an earlier one fails; returns their
+  export_target() results in order."""
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    return list(executor.map(
+      lambda target: export_target(target, dry_run, only_changed, use_cache),
+      config,
+    ))
 
 
 def parse_args():
@@ -34,14 +60,41 @@ def parse_args():
   parser.add_argument("-d", "--dry-run",
     help="Checks whether the exported patches need to be updated.",
     default=False, action='store_true')
+  parser.add_argument("--only-changed",
+    help="Only rewrite patch files whose content changed.",
+    default=False, action='store_true')
+  parser.add_argument("--cache",
+    help="Reuse previously formatted patches for commits that did not change.",
+    default=False, action='store_true')
+  parser.add_argument("-j", "--jobs", type=int, default=1,
+    help="Number of repos to export concurrently. Pass 0 to use one worker "
+         "per repo.")
+  parser.add_argument("--report",
+    help="Write the stale patches (with --dry-run) and errors for every "
+         "target to this JSON file.")
   return parser.parse_args()
 
 
 def main():
-  configs = parse_args().config
-  dry_run = parse_args().dry_run
-  for config_json in configs:
-    export_config(json.load(config_json), dry_run)
+  args = parse_args()
+  results = []
+  for config_json in args.config:
+    config = json.load(config_json)
+    jobs = args.jobs if args.jobs > 0 else max(len(config), 1)
+    results += export_config(config, args.dry_run, args.only_changed,
+                             args.cache, jobs)
+  if args.report:
+    with open(args.report, 'w', encoding='utf-8') as f:
+      json.dump({'dry_run': args.dry_run, 'targets': results}, f, indent=2)
+      f.write('\n')
+  failed = [r for r in results if r.get('error') or r.get('stale')]
+  if failed:
+    sys.stderr.write(
+      f"{len(failed)} of {len(results)} patch targets "
+      f"{'are not up to date' if args.dry_run else 'failed to export'}: "
+      f"{', '.join(r['patch_dir'] for r in failed)}\n"
+    )
+    sys.exit(1)
 
 
 if __name__ == '__main__':
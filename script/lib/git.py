@@ -6,19 +6,44 @@ Everything here should be project agnostic: it shouldn't rely on project's
 structure, or make assumptions about the passed arguments or calls' outcomes.
 """
 
+import atexit
+import datetime
+import email.utils
+import hashlib
 import io
+import itertools
+import json
 import os
 import posixpath
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(SCRIPT_DIR)
 
-from patches import PATCH_FILENAME_PREFIX, is_patch_location_line
+from patches import PATCH_FILENAME_PREFIX, is_patch_location_line, \
+                    iter_patch_stats, parse_diff, patch_lines_from_dir
 
 UPSTREAM_HEAD='refs/patches/upstream-head'
+PATCHED_TREE_CACHE_PREFIX='refs/patches/cache/'
+MAX_CACHED_PATCHED_TREES=8
+# How often, in seconds, am() checks which patch 'git am' is at.
+PATCH_START_POLL_INTERVAL=0.002
+# Keeps 'git ls-tree' command lines well under the OS limits.
+LS_TREE_PATHS_PER_CALL=1000
+FAST_IMPORT_REF='refs/patches/fast-import'
+SNAPSHOT_REF='refs/patches/mtime-snapshot'
+# Pass as |threeway| to only use a 3-way merge for patches that fail to apply
+# without one.
+THREEWAY_FALLBACK='fallback'
+MBOX_SEPARATOR=('From 0000000000000000000000000000000000000000 '
+                'Mon Sep 17 00:00:00 2001\n')
+EXPORT_CACHE_FILE='patch-export-cache.json'
+EXPORT_CACHE_VERSION=1
 
 def is_repo_root(path):
   path_exists = os.path.exists(path)
@@ -50,8 +75,47 @@ def get_repo_root(path):
   return get_repo_root(parent_path)
 
 
+def _record_patch_starts(proc, rebase_apply, patch_starts):
+  """Append the time.monotonic() at which 'git am' |proc| moves on to each
+  patch to |patch_starts|, by polling the number of the patch it is at in
+  |rebase_apply|/next until it exits. Patches that take less than the
+  polling interval may get the same start as the next one."""
+  next_path = os.path.join(rebase_apply, 'next')
+  current = 0
+  while True:
+    exited = proc.poll() is not None
+    try:
+      with open(next_path, encoding='utf-8') as f:
+        number = int(f.read())
+    except (OSError, ValueError):
+      number = current
+    if number > current:
+      patch_starts.extend([time.monotonic()] * (number - current))
+      current = number
+    if exited:
+      return
+    time.sleep(PATCH_START_POLL_INTERVAL)
+
+
 def am(repo, patch_data, threeway=False, directory=None, exclude=None,
-    committer_name=None, committer_email=None, keep_cr=True):
+    committer_name=None, committer_email=None, keep_cr=True, output=None,
+    patch_starts=None, fallbacks=None):
+  """Apply |patch_data|, a string or an iterable of lines, with 'git am'.
+  Lines are written to git as they are produced. If |output| is given, git's
+  stdout and stderr are written to it instead of being inherited from this
+  process. If |patch_starts| is a list, the time.monotonic() at which git
+  starts applying each patch is appended to it.
+
+  With |threeway| set to THREEWAY_FALLBACK, patches are applied without a
+  3-way merge and only a patch that fails is retried with one, after which
+  the rest of the series carries on without. The file name (or subject) of
+  every patch that needed it is appended to |fallbacks|, if it is a list."""
+  if threeway == THREEWAY_FALLBACK:
+    _am_with_fallback(repo, patch_data, fallbacks, directory=directory,
+                      exclude=exclude, committer_name=committer_name,
+                      committer_email=committer_email, keep_cr=keep_cr,
+                      output=output, patch_starts=patch_starts)
+    return
   args = []
   if threeway:
     args += ['--3way']
@@ -72,17 +136,777 @@ def am(repo, patch_data, threeway=False, directory=None, exclude=None,
     root_args += ['-c', 'user.email=' + committer_email]
   root_args += ['-c', 'commit.gpgsign=false']
   command = ['git'] + root_args + ['am'] + args
-  with subprocess.Popen(command, stdin=subprocess.PIPE) as proc:
-    proc.communicate(patch_data.encode('utf-8'))
-    if proc.returncode != 0:
+  if isinstance(patch_data, str):
+    patch_data = [patch_data]
+  rebase_apply = None
+  if patch_starts is not None:
+    rebase_apply = get_git_path(repo, 'rebase-apply')
+  with subprocess.Popen(command, stdin=subprocess.PIPE,
+                        stdout=output, stderr=output) as proc:
+    recorder = None
+    if patch_starts is not None:
+      recorder = threading.Thread(target=_record_patch_starts,
+                                  args=(proc, rebase_apply, patch_starts))
+      recorder.start()
+    try:
+      for chunk in patch_data:
+        proc.stdin.write(chunk.encode('utf-8'))
+      proc.stdin.close()
+    except BrokenPipeError:
+      # git exited early; its exit status below says why.
+      pass
+    if recorder is not None:
+      recorder.join()
+    if proc.wait() != 0:
       raise RuntimeError(f"Command {command} returned {proc.returncode}")
 
 
-def import_patches(repo, ref=UPSTREAM_HEAD, **kwargs):
+def _read_pending_patches(repo):
+  """Return the patches a stopped 'git am' has yet to apply, the one it
+  stopped at first, each as the mail 'git mailsplit' saved it."""
+  rebase_apply = get_git_path(repo, 'rebase-apply')
+  try:
+    with open(os.path.join(rebase_apply, 'next'), encoding='utf-8') as f:
+      first = int(f.read())
+    with open(os.path.join(rebase_apply, 'last'), encoding='utf-8') as f:
+      last = int(f.read())
+  except (OSError, ValueError):
+    return None
+  patches = []
+  for number in range(first, last + 1):
+    with open(os.path.join(rebase_apply, f'{number:04d}'),
+              encoding='utf-8', newline='') as f:
+      patches.append(f.read())
+  return patches
+
+
+def _join_mails(mails):
+  """Join split mails back into an mbox, adding the separator line that
+  'git mailsplit' may have dropped."""
+  return ''.join(
+    mail if mail.startswith('From ') else MBOX_SEPARATOR + mail
+    for mail in mails
+  )
+
+
+def _describe_mail(mail):
+  subject = None
+  for line in mail.splitlines():
+    if line.startswith(PATCH_FILENAME_PREFIX):
+      return line[len(PATCH_FILENAME_PREFIX):].strip()
+    if subject is None and line.startswith('Subject: '):
+      subject = line[len('Subject: '):].strip()
+  return subject
+
+
+def _am_with_fallback(repo, patch_data, fallbacks, patch_starts=None,
+                      **kwargs):
+  output = kwargs.get('output')
+  try:
+    am(repo, patch_data, patch_starts=patch_starts, **kwargs)
+    return
+  except RuntimeError:
+    pending = _read_pending_patches(repo)
+    if not pending:
+      raise
+  while True:
+    # Retry the patch git stopped at, on its own, with a 3-way merge. Its
+    # start was already recorded by the attempt that failed.
+    subprocess.check_call(['git', '-C', repo, 'am', '--quit'],
+                          stdout=output, stderr=output)
+    current, rest = pending[0], pending[1:]
+    try:
+      am(repo, _join_mails([current]), threeway=True, **kwargs)
+    except RuntimeError:
+      # Leave the same 'git am --3way' session behind as a full 3-way run
+      # would, stopped at this patch with the rest of the series queued.
+      subprocess.run(['git', '-C', repo, 'am', '--abort'],
+                     stdout=output, stderr=output, check=False)
+      am(repo, _join_mails(pending), threeway=True, **kwargs)
+      return
+    if fallbacks is not None:
+      fallbacks.append(_describe_mail(current))
+    if not rest:
+      return
+    try:
+      am(repo, _join_mails(rest), patch_starts=patch_starts, **kwargs)
+      return
+    except RuntimeError:
+      pending = _read_pending_patches(repo)
+      if not pending:
+        raise
+
+
+def import_patches(repo, ref=UPSTREAM_HEAD, cache_key=None, engine='am',
+                   report=None, patch_dir=None, **kwargs):
   """same as am(), but we save the upstream HEAD so we can refer to it when we
-  later export patches"""
+  later export patches.
+
+  If |cache_key| (e.g. a digest of the patch series) is given, the patched
+  commit is remembered under refs/patches/cache/ and reused on the next import
+  of the same series onto the same upstream HEAD instead of re-running
+  'git am'. Returns True if the patched tree was restored from that cache.
+
+  If |report| is a dict, it is filled in with the wall time of the import
+  and, for every patch that was read, the iter_patch_stats() counts and the
+  seconds it took to apply (None if it was never reached). With
+  threeway=THREEWAY_FALLBACK, the patches that needed a 3-way merge are
+  listed too. This happens even if the import fails.
+
+  In a partial clone, the blobs the series may read are fetched in one
+  request before it is applied. That takes a pass over the series of its
+  own, so it is only done if |patch_data| is a string or the series can be
+  read again from |patch_dir|."""
+  if report is None:
+    return _import_patches(repo, ref, cache_key, engine, patch_dir, **kwargs)
+  if kwargs.get('threeway') == THREEWAY_FALLBACK:
+    if kwargs.get('fallbacks') is None:
+      kwargs['fallbacks'] = []
+    report['threeway_fallbacks'] = kwargs['fallbacks']
+  stats = []
+  patch_starts = []
+  kwargs['patch_data'] = iter_patch_stats(kwargs['patch_data'], stats)
+  started = time.monotonic()
+  restored = False
+  applied = False
+  try:
+    restored = _import_patches(repo, ref, cache_key, engine, patch_dir,
+                               patch_starts=patch_starts, **kwargs)
+    applied = True
+    return restored
+  finally:
+    finished = time.monotonic()
+    if applied and not restored:
+      # Every patch was reached, even ones git got through too quickly for
+      # their start to be seen.
+      patch_starts += [finished] * (len(stats) - len(patch_starts))
+    patch_starts.append(finished)
+    for patch, start, end in zip(stats, patch_starts, patch_starts[1:]):
+      patch['seconds'] = end - start
+    for patch in stats[len(patch_starts) - 1:]:
+      patch['seconds'] = None
+    report.update({
+      'engine': engine,
+      'restored_from_cache': restored,
+      'seconds': finished - started,
+      'patches': stats,
+    })
+
+
+def _import_patches(repo, ref, cache_key, engine, patch_dir, **kwargs):
+  cache_ref = None
+  if cache_key is not None:
+    cache_ref = get_patched_tree_cache_ref(repo, cache_key, patch_dir,
+                                           **kwargs)
+    cached_commit = try_get_commit_for_ref(repo, cache_ref)
+    if cached_commit is not None:
+      update_ref(repo=repo, ref=ref, newvalue='HEAD')
+      fast_forward(repo, cached_commit, output=kwargs.get('output'))
+      return True
   update_ref(repo=repo, ref=ref, newvalue='HEAD')
-  am(repo=repo, **kwargs)
+  remote = get_promisor_remote(repo)
+  if remote is not None:
+    if isinstance(kwargs['patch_data'], str):
+      preimage_data = kwargs['patch_data']
+    elif patch_dir is not None:
+      preimage_data = patch_lines_from_dir(patch_dir)
+    else:
+      preimage_data = None
+    if preimage_data is not None:
+      # A 3-way merge, even only as a fallback, may read the pre-images.
+      prefetch_preimages(repo, remote, preimage_data,
+                         threeway=bool(kwargs.get('threeway')),
+                         directory=kwargs.get('directory'),
+                         output=kwargs.get('output'))
+  IMPORT_ENGINES[engine](repo=repo, **kwargs)
+  if cache_ref is not None:
+    update_ref(repo=repo, ref=cache_ref, newvalue='HEAD')
+    prune_patched_tree_cache(repo)
+  return False
+
+
+def get_promisor_remote(repo):
+  """Return the remote a partial clone fetches missing objects from, or None
+  if |repo| is not a partial clone."""
+  args = ['git', '-C', repo, 'config', '--get-regexp',
+          r'^remote\..*\.promisor$']
+  result = subprocess.run(args, stdout=subprocess.PIPE, check=False)
+  for line in result.stdout.decode('utf-8').splitlines():
+    key, _, value = line.partition(' ')
+    if value.lower() in ('true', 'yes', 'on', '1'):
+      return key[len('remote.'):-len('.promisor')]
+  args = ['git', '-C', repo, 'config', '--get', 'extensions.partialclone']
+  result = subprocess.run(args, stdout=subprocess.PIPE, check=False)
+  return result.stdout.decode('utf-8').strip() or None
+
+
+def get_missing_objects(repo, object_ids):
+  """Return the subset of |object_ids| that |repo| does not have, without
+  making a partial clone fetch them: they are listed in a throwaway tree,
+  which 'git rev-list --missing=print' walks without fetching."""
+  if not object_ids:
+    return set()
+  entries = ''.join(
+    f'100644 blob {object_id}\t{number}\n'
+    for number, object_id in enumerate(object_ids)
+  )
+  args = ['git', '-C', repo, 'mktree', '--missing']
+  tree = subprocess.run(args, input=entries.encode('ascii'),
+                        stdout=subprocess.PIPE, check=True).stdout
+  args = ['git', '-C', repo, 'rev-list', '--objects', '--missing=print',
+          '--no-walk', tree.decode('ascii').strip()]
+  output = subprocess.check_output(args).decode('utf-8', 'surrogateescape')
+  return {line[1:] for line in output.splitlines() if line.startswith('?')}
+
+
+def fetch_objects(repo, remote, object_ids, output=None):
+  """Fetch |object_ids| from a partial clone's promisor |remote| in a single
+  request, the way git itself fetches a missing object."""
+  args = ['git', '-C', repo, '-c', 'fetch.negotiationAlgorithm=noop', 'fetch',
+          remote, '--no-tags', '--no-write-fetch-head',
+          '--recurse-submodules=no', '--filter=blob:none', '--stdin']
+  data = ''.join(f'{object_id}\n' for object_id in object_ids)
+  subprocess.run(args, input=data.encode('ascii'), stdout=output,
+                 stderr=output, check=True)
+
+
+def get_preimage_objects(repo, patch_data, commit, threeway=False,
+                         directory=None):
+  """Return the blobs that applying |patch_data| to |commit| may read: the
+  blob at |commit| of every file the series changes, and with |threeway|,
+  the pre-image blob on each 'index' line that the series does not produce
+  itself. An iterable |patch_data| is read one patch at a time."""
+  if isinstance(patch_data, str):
+    patches = [patch_data.splitlines(True)]
+  else:
+    patches = iter_split_patches(patch_data)
+  paths = set()
+  blobs = set()
+  produced = set()
+  file_patches = (fp for patch in patches for fp in parse_diff(patch))
+  for file_patch in file_patches:
+    if file_patch.old_path is not None:
+      path = file_patch.old_path
+      if directory:
+        path = directory.rstrip('/') + '/' + path
+      paths.add(path)
+      old_blob = file_patch.old_blob
+      if (threeway and old_blob is not None and old_blob.strip('0')
+          and len(old_blob) in (40, 64) and old_blob not in produced):
+        blobs.add(old_blob)
+    if file_patch.new_blob is not None:
+      produced.add(file_patch.new_blob)
+  if paths:
+    # Not 'cat-file --batch-check': in a partial clone, that fetches each
+    # missing blob on its own just to report its type.
+    for _, object_type, object_id, _ in ls_tree(repo, commit, paths):
+      if object_type == 'blob':
+        blobs.add(object_id)
+  return blobs
+
+
+def prefetch_preimages(repo, remote, patch_data, threeway=False,
+                       directory=None, output=None):
+  """Fetch every blob that applying |patch_data| to HEAD may read and that a
+  partial clone of |remote| is missing, in one request, rather than letting
+  git fetch them one at a time as it gets to them. Returns how many were
+  missing. Failing to fetch them is not an error: git can still fetch them
+  later."""
+  wanted = get_preimage_objects(repo, patch_data, 'HEAD', threeway, directory)
+  missing = get_missing_objects(repo, sorted(wanted))
+  if not missing:
+    return 0
+  log = output if output is not None else sys.stdout.buffer
+  try:
+    fetch_objects(repo, remote, sorted(missing), output=output)
+    log.write(f'Prefetched {len(missing)} missing blobs from {remote}\n'
+              .encode('utf-8'))
+  except subprocess.CalledProcessError:
+    log.write(f'Failed to prefetch {len(missing)} missing blobs from '
+              f'{remote}\n'.encode('utf-8'))
+  log.flush()
+  return len(missing)
+
+
+def get_patched_tree_cache_ref(repo, cache_key, patch_dir=None, **kwargs):
+  """The cache ref for applying a series identified by |cache_key| onto the
+  current HEAD of |repo| with the am() options in |kwargs|. |patch_dir| is
+  part of the key too, since it is written into every patched commit."""
+  key = hashlib.sha256()
+  key.update(get_commit_for_ref(repo, 'HEAD').encode('utf-8'))
+  key.update(cache_key.encode('utf-8'))
+  key.update(f'\0patch_dir={patch_dir!r}'.encode('utf-8'))
+  for option in ('threeway', 'directory', 'exclude', 'committer_name',
+                 'committer_email', 'keep_cr'):
+    key.update(f'\0{option}={kwargs.get(option)!r}'.encode('utf-8'))
+  return PATCHED_TREE_CACHE_PREFIX + key.hexdigest()
+
+
+def prune_patched_tree_cache(repo, keep=MAX_CACHED_PATCHED_TREES):
+  """Drop all but the |keep| most recently created patched tree cache refs."""
+  args = [
+    'git', '-C', repo, 'for-each-ref', '--sort=-committerdate',
+    '--format=%(refname)', PATCHED_TREE_CACHE_PREFIX
+  ]
+  refs = subprocess.check_output(args).decode('utf-8').splitlines()
+  for stale_ref in refs[keep:]:
+    subprocess.check_call(['git', '-C', repo, 'update-ref', '-d', stale_ref])
+
+
+def fast_forward(repo, commit, output=None):
+  """Move HEAD (and the checked out branch, if any) forward to |commit|,
+  updating only the files that differ."""
+  args = ['git', '-C', repo, 'merge', '--ff-only', '--quiet', commit]
+  subprocess.check_call(args, stdout=output, stderr=output)
+
+
+class GitSession:
+  """Long-running 'git cat-file --batch' and '--batch-check' processes for
+  |repo|, so that object, blob and ref lookups are answered over a pipe
+  instead of starting a git process for each one.
+
+  Answers that can't change are cached for the life of the session: lookups
+  by full object id (or '<object id>:<path>'), parsed trees and commit
+  counts between two object ids. Refs are resolved afresh every time, since
+  they may be moved by other processes. Use get_session() to share one
+  session per repo across a process."""
+
+  def __init__(self, repo):
+    self.repo = repo
+    self._batch = None
+    self._check = None
+    self._lock = threading.Lock()
+    self._info = {}
+    self._trees = {}
+    self._counts = {}
+
+  def _start(self, option):
+    return subprocess.Popen(['git', '-C', self.repo, 'cat-file', option],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+  @staticmethod
+  def _is_immutable(name):
+    return OBJECT_ID.match(name) is not None
+
+  def read(self, name):
+    """Return (type, data) for the object |name|, or None if it is missing."""
+    with self._lock:
+      if self._batch is None:
+        self._batch = self._start('--batch')
+      self._batch.stdin.write(name.encode('utf-8') + b'\n')
+      self._batch.stdin.flush()
+      header = self._batch.stdout.readline().rstrip(b'\n')
+      if header.endswith((b' missing', b' ambiguous')):
+        return None
+      object_id, object_type, size = header.decode('ascii').split()
+      data = self._batch.stdout.read(int(size))
+      self._batch.stdout.read(1)
+    if self._is_immutable(name):
+      self._info[name] = (object_id, object_type, int(size))
+    return object_type, data
+
+  def info(self, name):
+    """Return (object_id, type, size) for |name|, or None if it is missing."""
+    return self.info_many([name])[0]
+
+  def info_many(self, names):
+    """Like info() for each of |names|, sending every lookup that isn't
+    cached down the pipe in one go."""
+    answers = {name: self._info[name] for name in names if name in self._info}
+    pending = list(dict.fromkeys(n for n in names if n not in answers))
+    if pending:
+      with self._lock:
+        if self._check is None:
+          self._check = self._start('--batch-check')
+        # Write from another thread so that a long list can't fill both
+        # pipes and deadlock.
+        writer = threading.Thread(
+          target=_write_lines,
+          args=(self._check.stdin, [name + '\n' for name in pending]))
+        writer.start()
+        lines = [self._check.stdout.readline() for _ in pending]
+        writer.join()
+      for name, line in zip(pending, lines):
+        line = line.decode('utf-8', 'surrogateescape').rstrip('\n')
+        if line.endswith((' missing', ' ambiguous')):
+          answer = None
+        else:
+          object_id, object_type, size = line.split()
+          answer = (object_id, object_type, int(size))
+        # Objects may still be fetched or created, so only cache hits for
+        # bare object ids.
+        if self._is_immutable(name) and (answer is not None or ':' in name):
+          self._info[name] = answer
+        answers[name] = answer
+    return [answers[name] for name in names]
+
+  def exists(self, name):
+    return self.info(name) is not None
+
+  def resolve(self, ref):
+    """Return the object id that |ref| names, or None if it doesn't exist."""
+    answer = self.info(ref)
+    return answer[0] if answer is not None else None
+
+  def tree_entries(self, tree):
+    """Return {name: (mode, object_id)} for the tree object |tree|, or None if
+    it doesn't exist or isn't a tree."""
+    object_id = self.resolve(tree)
+    if object_id is None:
+      return None
+    if object_id not in self._trees:
+      entry = self.read(object_id)
+      if entry is None or entry[0] != 'tree':
+        return None
+      data = entry[1]
+      oid_size = len(object_id) // 2
+      entries = {}
+      i = 0
+      while i < len(data):
+        space = data.index(b' ', i)
+        nul = data.index(b'\0', space)
+        name = data[space + 1:nul].decode('utf-8', 'surrogateescape')
+        entries[name] = (data[i:space].decode('ascii').zfill(6),
+                         data[nul + 1:nul + 1 + oid_size].hex())
+        i = nul + 1 + oid_size
+      self._trees[object_id] = entries
+    return self._trees[object_id]
+
+  def tree_entry_mode(self, commit, path):
+    """Return the mode of |path| in |commit|, or None if it doesn't exist."""
+    directory, _, name = path.rpartition('/')
+    entries = self.tree_entries(f'{commit}:{directory}')
+    if entries is None or name not in entries:
+      return None
+    return entries[name][0]
+
+  def count_commits(self, commit_range):
+    """Like 'git rev-list --count |commit_range|'."""
+    since, dots, until = commit_range.partition('..')
+    if not dots or until.startswith('.'):
+      return _count_commits(self.repo, commit_range)
+    key = (self.resolve(since or 'HEAD'), self.resolve(until or 'HEAD'))
+    if None in key:
+      return _count_commits(self.repo, commit_range)
+    if key not in self._counts:
+      self._counts[key] = _count_commits(self.repo, f'{key[0]}..{key[1]}')
+    return self._counts[key]
+
+  def close(self):
+    with self._lock:
+      for proc in (self._batch, self._check):
+        if proc is not None:
+          proc.stdin.close()
+          proc.wait()
+          proc.stdout.close()
+      self._batch = self._check = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def _write_lines(stream, lines):
+  for line in lines:
+    stream.write(line.encode('utf-8', 'surrogateescape'))
+  stream.flush()
+
+
+OBJECT_ID = re.compile('^(?:[0-9a-f]{40}|[0-9a-f]{64})(?::|$)')
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(repo):
+  """Return the GitSession for |repo| shared by every caller in this
+  process. Sessions are closed when the process exits."""
+  key = os.path.realpath(repo)
+  with _sessions_lock:
+    if key not in _sessions:
+      if not _sessions:
+        atexit.register(close_sessions)
+      _sessions[key] = GitSession(repo)
+    return _sessions[key]
+
+
+def close_sessions():
+  with _sessions_lock:
+    for session in _sessions.values():
+      session.close()
+    _sessions.clear()
+
+
+def ls_tree(repo, treeish, paths=None):
+  """Return (mode, type, object_id, path) for every file in |treeish|, or
+  only for those of |paths| that it has. Only trees are read, so a partial
+  clone does not fetch any blobs."""
+  if paths is None:
+    chunks = [[]]
+  else:
+    paths = sorted(paths)
+    chunks = [paths[i:i + LS_TREE_PATHS_PER_CALL]
+              for i in range(0, len(paths), LS_TREE_PATHS_PER_CALL)]
+  entries = []
+  for chunk in chunks:
+    args = ['git', '--literal-pathspecs', '-C', repo, 'ls-tree', '-r', '-z',
+            '--full-tree', treeish, '--', *chunk]
+    output = subprocess.check_output(args).decode('utf-8', 'surrogateescape')
+    for entry in output.split('\0'):
+      if entry:
+        info, path = entry.split('\t', 1)
+        entries.append((*info.split(), path))
+  return entries
+
+
+def get_committer_ident(repo, committer_name=None, committer_email=None):
+  """Return (name_and_email, timestamp, tz) as 'git am' would commit with."""
+  args = ['git', '-C', repo]
+  if committer_name is not None:
+    args += ['-c', 'user.name=' + committer_name]
+  if committer_email is not None:
+    args += ['-c', 'user.email=' + committer_email]
+  args += ['var', 'GIT_COMMITTER_IDENT']
+  ident = subprocess.check_output(args).decode('utf-8').strip()
+  name_and_email, timestamp, tz = ident.rsplit(' ', 2)
+  return name_and_email, int(timestamp), tz
+
+
+def stripspace(message):
+  """Python version of git's strbuf_stripspace(): trailing whitespace and
+  surplus blank lines are removed."""
+  lines = []
+  empties = 0
+  for line in message.split('\n'):
+    line = line.rstrip(' \t\r\n')
+    if not line:
+      empties += 1
+      continue
+    if empties and lines:
+      lines.append('')
+    lines.append(line)
+    empties = 0
+  return '\n'.join(lines) + '\n' if lines else ''
+
+
+def mailinfo(repo, patch):
+  """Run 'git mailinfo' over a single mail the way 'git am' does and return
+  (author, email, date, message, diff lines)."""
+  with tempfile.TemporaryDirectory() as tmp:
+    msg_path = os.path.join(tmp, 'msg')
+    patch_path = os.path.join(tmp, 'patch')
+    args = ['git', '-C', repo, 'mailinfo', '-u', msg_path, patch_path]
+    info = subprocess.run(args, input=''.join(patch).encode('utf-8'),
+                          stdout=subprocess.PIPE, check=True).stdout
+    with open(msg_path, encoding='utf-8', errors='surrogateescape') as f:
+      log_message = f.read()
+    with open(patch_path, encoding='utf-8', errors='surrogateescape',
+              newline='') as f:
+      diff = f.readlines()
+  headers = {'Author': '', 'Email': '', 'Subject': '', 'Date': ''}
+  subject = []
+  for line in info.decode('utf-8', errors='surrogateescape').splitlines():
+    key, _, value = line.partition(': ')
+    if key == 'Subject':
+      subject.append(value)
+    elif key in headers:
+      headers[key] = value
+  message = stripspace('\n'.join(subject) + '\n\n' + log_message)
+  return headers['Author'], headers['Email'], headers['Date'], message, diff
+
+
+def fast_import(repo, patch_data, threeway=False, directory=None,
+                exclude=None, committer_name=None, committer_email=None,
+                keep_cr=True, output=None, patch_starts=None, fallbacks=None):
+  """Apply |patch_data| like am(), but leave the index and worktree alone
+  until the end: each patch is applied with 'git apply --cached' to a
+  scratch index, the commits are built from the trees written from it in a
+  single 'git fast-import' stream, and the result is checked out once.
+
+  If a patch does not apply, the commits before it are checked out and the
+  rest of the series, from that patch on, is handed to am(), which stops at
+  the same patch and leaves its session to be resolved as usual.
+
+  It never makes a 3-way merge, so |threeway| (THREEWAY_FALLBACK included)
+  and |fallbacks| are refused rather than ignored."""
+  if threeway or fallbacks is not None:
+    raise ValueError('The fast-import engine does not support 3-way merges, '
+                     'not even as a fallback')
+  base = get_commit_for_ref(repo, 'HEAD')
+  committer, timestamp, tz = get_committer_ident(
+    repo, committer_name, committer_email)
+  offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+  committer_date = email.utils.format_datetime(datetime.datetime.fromtimestamp(
+    timestamp, datetime.timezone(-offset if tz[0] == '-' else offset)))
+  apply_args = ['git', '-C', repo, 'apply', '--cached']
+  if directory is not None:
+    apply_args += ['--directory', directory]
+  for path_pattern in exclude or []:
+    apply_args += ['--exclude', path_pattern]
+  command = ['git', '-C', repo, 'fast-import', '--quiet', '--force', '--done',
+             '--date-format=rfc2822']
+  log = output if output is not None else sys.stdout.buffer
+  if isinstance(patch_data, str):
+    patch_data = patch_data.splitlines(True)
+  patches = iter_split_patches(patch_data)
+  failed = None
+  with tempfile.TemporaryDirectory() as tmp, \
+       subprocess.Popen(command, stdin=subprocess.PIPE) as importer:
+    env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, 'index'))
+    try:
+      subprocess.check_call(['git', '-C', repo, 'read-tree', base], env=env)
+      for number, patch in enumerate(patches, 1):
+        lines = patch
+        if not keep_cr:
+          lines = [re.sub('\r\n$', '\n', line) for line in patch]
+        author, author_email, date, message, diff = mailinfo(repo, lines)
+        subject = message.split('\n', 1)[0]
+        if patch_starts is not None:
+          patch_starts.append(time.monotonic())
+        log.write(f'Applying: {subject}\n'.encode('utf-8', 'surrogateescape'))
+        log.flush()
+        result = subprocess.run(
+          apply_args, input=''.join(diff).encode('utf-8', 'surrogateescape'),
+          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env,
+          check=False)
+        if result.returncode != 0:
+          failed = patch
+          break
+        tree = subprocess.check_output(['git', '-C', repo, 'write-tree'],
+                                       env=env).decode('ascii').strip()
+        encoded = message.encode('utf-8', 'surrogateescape')
+        importer.stdin.write(
+          f'commit {FAST_IMPORT_REF}\n'
+          f'author {author} <{author_email}> {date}\n'
+          f'committer {committer} {committer_date}\n'
+          f'data {len(encoded)}\n'.encode('utf-8', 'surrogateescape')
+          + encoded + b'\n'
+          + (f'from {base}\n'.encode('ascii') if number == 1 else b'')
+          + f'M 040000 {tree} ""\n\n'.encode('ascii')
+        )
+      importer.stdin.write(b'done\n')
+      importer.stdin.close()
+    except BaseException:
+      importer.kill()
+      try:
+        importer.stdin.close()
+      except BrokenPipeError:
+        pass
+      raise
+    if importer.wait() != 0:
+      raise RuntimeError(f"Command {command} returned {importer.returncode}")
+  patched = try_get_commit_for_ref(repo, FAST_IMPORT_REF)
+  if patched is not None:
+    subprocess.check_call(
+      ['git', '-C', repo, 'update-ref', '-d', FAST_IMPORT_REF])
+    fast_forward(repo, patched, output=output)
+  if failed is None:
+    return
+  # The start of the failing patch is already recorded.
+  am_starts = []
+  try:
+    am(repo, itertools.chain(failed, (line for patch in patches
+                                      for line in patch)),
+       directory=directory, exclude=exclude, committer_name=committer_name,
+       committer_email=committer_email, keep_cr=keep_cr, output=output,
+       patch_starts=am_starts if patch_starts is not None else None)
+  finally:
+    if patch_starts is not None:
+      patch_starts += am_starts[1:]
+
+
+IMPORT_ENGINES = {
+  'am': am,
+  'fast-import': fast_import,
+}
+
+
+def add_worktree(repo, path, commit):
+  args = ['git', '-C', repo, 'worktree', 'add', '--detach', '--quiet', path,
+          commit]
+  subprocess.check_call(args)
+
+
+def remove_worktree(repo, path):
+  args = ['git', '-C', repo, 'worktree', 'remove', '--force', path]
+  subprocess.check_call(args)
+
+
+def list_files(repo):
+  """Return the paths of the regular files tracked in |repo|'s index."""
+  args = ['git', '-C', repo, 'ls-files', '--stage', '-z']
+  output = subprocess.check_output(args).decode('utf-8', 'surrogateescape')
+  files = []
+  for entry in output.split('\0'):
+    if entry:
+      info, path = entry.split('\t', 1)
+      if info.startswith('100'):
+        files.append(path)
+  return files
+
+
+def snapshot_worktree(repo):
+  """Return a commit whose tree holds the current content of every tracked
+  file in |repo|, including uncommitted changes. Nothing is checked out or
+  reset."""
+  args = ['git', '-C', repo, 'stash', 'create']
+  result = subprocess.run(args, stdout=subprocess.PIPE, check=False)
+  commit = result.stdout.decode('utf-8').strip()
+  # 'git stash create' has nothing to say when there are no changes. If it
+  # fails, files with uncommitted changes just won't match HEAD later.
+  return commit or get_commit_for_ref(repo, 'HEAD')
+
+
+def get_changed_files(repo, commit):
+  """Return the set of paths whose content in |repo|'s working tree differs
+  from |commit|."""
+  args = ['git', '-C', repo, 'diff', '--name-only', '--no-renames', '-z',
+          commit, '--']
+  output = subprocess.check_output(args).decode('utf-8', 'surrogateescape')
+  return {path for path in output.split('\0') if path}
+
+
+def refresh_index(repo):
+  args = ['git', '-C', repo, 'update-index', '-q', '--refresh']
+  subprocess.run(args, stdout=subprocess.DEVNULL, check=False)
+
+
+def describe_commits(repo, commit_range):
+  """Return the tree, author and message of each commit in |commit_range|,
+  oldest first, for comparing the results of two imports."""
+  args = ['git', '-C', repo, 'log', '--reverse', '-z',
+          '--format=%T%x00%an <%ae> %ad%x00%B', commit_range]
+  fields = subprocess.check_output(args).decode('utf-8').split('\0')
+  return [
+    tuple(fields[i:i + 3]) for i in range(0, len(fields) - 2, 3)
+  ]
+
+
+def benchmark_import_engines(repo, patch_data, engines=None, **kwargs):
+  """Apply the same series with each import engine in a scratch worktree of
+  |repo| and return {engine: (seconds, commits)}, where |commits| is the
+  describe_commits() result, or None if the engine failed."""
+  base = get_commit_for_ref(repo, 'HEAD')
+  results = {}
+  for engine in engines or IMPORT_ENGINES:
+    worktree = tempfile.mkdtemp(prefix=f'import-{engine}-')
+    os.rmdir(worktree)
+    add_worktree(repo, worktree, base)
+    try:
+      start = time.perf_counter()
+      try:
+        IMPORT_ENGINES[engine](repo=worktree, patch_data=patch_data, **kwargs)
+        elapsed = time.perf_counter() - start
+        commits = describe_commits(worktree, base + '..HEAD')
+      except RuntimeError as e:
+        sys.stderr.write(f'{engine}: {e}\n')
+        elapsed = time.perf_counter() - start
+        commits = None
+      results[engine] = (elapsed, commits)
+    finally:
+      remove_worktree(repo, worktree)
+  return results
 
 
 def update_ref(repo, ref, newvalue):
@@ -91,14 +915,31 @@ def update_ref(repo, ref, newvalue):
   return subprocess.check_call(args)
 
 
+def delete_ref(repo, ref):
+  args = ['git', '-C', repo, 'update-ref', '-d', ref]
+
+  return subprocess.check_call(args)
+
+
 def get_commit_for_ref(repo, ref):
+  commit = get_session(repo).resolve(ref)
+  if commit is not None:
+    return commit
+  # Let git explain what is wrong with |ref|.
   args = ['git', '-C', repo, 'rev-parse', '--verify', ref]
   return subprocess.check_output(args).decode('utf-8').strip()
 
-def get_commit_count(repo, commit_range):
+def try_get_commit_for_ref(repo, ref):
+  """Like get_commit_for_ref(), but returns None if |ref| does not exist."""
+  return get_session(repo).resolve(ref + '^{commit}')
+
+def _count_commits(repo, commit_range):
   args = ['git', '-C', repo, 'rev-list', '--count', commit_range]
   return int(subprocess.check_output(args).decode('utf-8').strip())
 
+def get_commit_count(repo, commit_range):
+  return get_session(repo).count_commits(commit_range)
+
 def guess_base_commit(repo, ref):
   """Guess which commit the patches might be based on"""
   try:
@@ -116,8 +957,8 @@ def guess_base_commit(repo, ref):
     return subprocess.check_output(args).decode('utf-8').rsplit('-', 2)[0:2]
 
 
-def format_patch(repo, since):
-  args = [
+def format_patch_args(repo, since):
+  return [
     'git',
     '-C',
     repo,
@@ -151,20 +992,270 @@ def format_patch(repo, since):
     '--full-index',
     since
   ]
+
+
+def format_patch(repo, since):
+  args = format_patch_args(repo, since)
   return subprocess.check_output(args).decode('utf-8')
 
 
+def iter_format_patch(repo, since):
+  """Like format_patch(), but yield the output line by line as git produces
+  it. Line endings are kept in case any patches target files with CRLF."""
+  args = format_patch_args(repo, since)
+  with subprocess.Popen(args, stdout=subprocess.PIPE) as proc:
+    yield from io.TextIOWrapper(proc.stdout, encoding='utf-8', newline='')
+  if proc.returncode != 0:
+    raise subprocess.CalledProcessError(proc.returncode, args)
+
+
+def get_git_path(repo, path):
+  """Resolve |path| inside the git directory of |repo|."""
+  args = ['git', '-C', repo, 'rev-parse', '--git-path', path]
+  git_path = subprocess.check_output(args).decode('utf-8').strip()
+  return os.path.join(repo, git_path)
+
+
+def get_commit_fingerprints(repo, commit_range):
+  """Return (commit, parents, fingerprint) for each commit in |commit_range|,
+  oldest first. The fingerprint covers what format_patch() output depends on
+  (author, message and the blobs on either side of every changed file) but
+  not the commit's ancestry, so it survives rebases that leave the patch
+  itself alone."""
+  args = ['git', '-C', repo, 'log', '--reverse', '--no-renames', '--raw',
+          '--no-abbrev', '--format=%x00%H %P%x00%an <%ae> %ad%n%B',
+          commit_range]
+  fields = subprocess.check_output(args).split(b'\0')
+  fingerprints = []
+  for header, details in zip(fields[1::2], fields[2::2]):
+    commit, *parents = header.decode('ascii').split()
+    fingerprints.append(
+      (commit, parents, hashlib.sha256(details).hexdigest())
+    )
+  return fingerprints
+
+
+def get_patch_ids(repo, patches):
+  """Return {position: patch_id} for |patches|, a list of patch texts such as
+  'git format-patch' writes, using a single 'git patch-id --stable'. Patches
+  without a diff are left out."""
+  stream = []
+  for position, patch in enumerate(patches):
+    # patch-id names each result after the commit on the 'From ' line, which
+    # exported patches zero out, so number them instead.
+    if patch.startswith('From '):
+      patch = patch.split('\n', 1)[1] if '\n' in patch else ''
+    stream.append(f'From {position:040x} Mon Sep 17 00:00:00 2001\n{patch}')
+    if not patch.endswith('\n'):
+      stream.append('\n')
+  args = ['git', '-C', repo, 'patch-id', '--stable']
+  output = subprocess.run(args, input=''.join(stream).encode('utf-8'),
+                          stdout=subprocess.PIPE, check=True).stdout
+  patch_ids = {}
+  for line in output.decode('ascii').splitlines():
+    patch_id, position = line.split()
+    patch_ids[int(position, 16)] = patch_id
+  return patch_ids
+
+
+def get_commit_patch_ids(repo, commit_range):
+  """Return {patch_id: commit} for every non-merge commit in |commit_range|,
+  piping a single 'git log' through a single 'git patch-id --stable'. The
+  newest commit wins if several have the same patch id."""
+  log_args = ['git', '-C', repo, 'log', '--no-merges', '--no-color', '-p',
+              '--full-index', '--format=commit %H', commit_range]
+  args = ['git', '-C', repo, 'patch-id', '--stable']
+  with subprocess.Popen(log_args, stdout=subprocess.PIPE) as log:
+    output = subprocess.run(args, stdin=log.stdout, stdout=subprocess.PIPE,
+                            check=True).stdout
+    log.stdout.close()
+    if log.wait() != 0:
+      raise RuntimeError(f"Command {log_args} returned {log.returncode}")
+  commits = {}
+  for line in output.decode('ascii').splitlines():
+    patch_id, commit = line.split()
+    commits.setdefault(patch_id, commit)
+  return commits
+
+
+def get_commit_subjects(repo, commit_range):
+  """Return {subject: commit} for every non-merge commit in |commit_range|,
+  newest first."""
+  args = ['git', '-C', repo, 'log', '--no-merges', '--format=%H %s',
+          commit_range]
+  subjects = {}
+  output = subprocess.check_output(args).decode('utf-8', 'replace')
+  for line in output.splitlines():
+    commit, _, subject = line.partition(' ')
+    subjects.setdefault(subject, commit)
+  return subjects
+
+
+def get_export_cache_salt(repo):
+  """Everything besides the commit itself that affects format_patch()."""
+  salt = hashlib.sha256()
+  salt.update(subprocess.check_output(['git', '--version']))
+  salt.update('\0'.join(format_patch_args('', '')).encode('utf-8'))
+  with open(os.path.join(SCRIPT_DIR, 'electron.gitattributes'), 'rb') as f:
+    salt.update(f.read())
+  salt.update(str(EXPORT_CACHE_VERSION).encode('ascii'))
+  salt.update(os.path.realpath(repo).encode('utf-8'))
+  return salt.hexdigest()
+
+
+def load_export_cache(path, salt):
+  try:
+    with open(path, encoding='utf-8') as f:
+      cache = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  if cache.get('salt') != salt:
+    return {}
+  return cache.get('patches', {})
+
+
+def save_export_cache(path, salt, patches):
+  with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+    json.dump({'salt': salt, 'patches': patches}, f)
+  os.replace(path + '.tmp', path)
+
+
+def iter_format_commits(repo, commits):
+  """Yield the patch for each of |commits|, a list of (commit, parents, ...)
+  tuples in oldest-first order whose commits each have a single parent.
+  Every run in which a commit is the parent of the next is formatted by a
+  single 'git format-patch' call."""
+  i = 0
+  while i < len(commits):
+    j = i + 1
+    while j < len(commits) and commits[j][1] == [commits[j - 1][0]]:
+      j += 1
+    run_range = f'{commits[i][0]}~..{commits[j - 1][0]}'
+    formatted = 0
+    for patch in iter_split_patches(iter_format_patch(repo, run_range)):
+      formatted += 1
+      yield patch
+    if formatted != j - i:
+      raise RuntimeError(
+        f'Expected {j - i} patches from {run_range}, got {formatted}'
+      )
+    i = j
+
+
+def get_patch_file_names(repo, commit_range):
+  """Return (commit, parents, file_name) for each commit in |commit_range|,
+  oldest first, where file_name is what get_file_name() will call the
+  commit's patch. Only commits without a 'Patch-Filename:' trailer are
+  formatted, since their name depends on how 'git format-patch' writes the
+  subject."""
+  args = ['git', '-C', repo, 'log', '--reverse',
+          '--format=%x00%H %P%x00%s%n%b', commit_range]
+  fields = subprocess.check_output(args).decode('utf-8').split('\0')
+  file_names = []
+  unnamed = []
+  for header, message in zip(fields[1::2], fields[2::2]):
+    commit, *parents = header.split()
+    file_name = None
+    for line in message.splitlines():
+      if line.startswith(PATCH_FILENAME_PREFIX):
+        file_name = line[len(PATCH_FILENAME_PREFIX):]
+        break
+    if not file_name and len(parents) == 1:
+      unnamed.append(len(file_names))
+    elif not file_name:
+      # 'git format-patch' skips merges, so this name is never written.
+      file_name = munge_subject_to_filename(message.split('\n', 1)[0])
+    file_names.append((commit, parents, file_name))
+  patches = iter_format_commits(repo, [file_names[i] for i in unnamed])
+  for i, patch in zip(unnamed, patches):
+    commit, parents, _ = file_names[i]
+    file_names[i] = (commit, parents, get_file_name(patch))
+  return file_names
+
+
+def iter_selected_patches(repo, patch_range, file_names, counts):
+  """Yield the patches in |patch_range| that would be written to one of
+  |file_names|, without formatting the rest. |counts| is set to the number
+  of patches selected and the number in the range."""
+  log_range = patch_range if '..' in patch_range else patch_range + '..HEAD'
+  commits = get_patch_file_names(repo, log_range)
+  selected = [commit for commit in commits if commit[2] in file_names]
+  counts[:] = [len(selected), len(commits)]
+  if any(len(parents) != 1 for _, parents, _ in selected):
+    for patch in iter_split_patches(iter_format_patch(repo, patch_range)):
+      if get_file_name(patch) in file_names:
+        yield patch
+    return
+  yield from iter_format_commits(repo, selected)
+
+
+def iter_exported_patches(repo, patch_range, use_cache=False):
+  """Yield the patches for |patch_range| as lists of lines, the same as
+  splitting format_patch() output.
+
+  With |use_cache|, the raw output for every commit is kept in the git
+  directory keyed by its fingerprint, and only commits that are not in the
+  cache are passed to 'git format-patch'."""
+  if not use_cache:
+    yield from iter_split_patches(iter_format_patch(repo, patch_range))
+    return
+  # Like format-patch, treat a single revision as "everything since".
+  log_range = patch_range if '..' in patch_range else patch_range + '..HEAD'
+  fingerprints = get_commit_fingerprints(repo, log_range)
+  if any(len(parents) != 1 for _, parents, _ in fingerprints):
+    # Runs of uncached commits are formatted as 'first~..last', which only
+    # selects exactly those commits in linear history.
+    yield from iter_split_patches(iter_format_patch(repo, patch_range))
+    return
+  cache_path = get_git_path(repo, EXPORT_CACHE_FILE)
+  salt = get_export_cache_salt(repo)
+  cache = load_export_cache(cache_path, salt)
+  fresh = {}
+  reused = 0
+  i = 0
+  while i < len(fingerprints):
+    if fingerprints[i][2] in cache:
+      key = fingerprints[i][2]
+      fresh[key] = cache[key]
+      reused += 1
+      i += 1
+      yield fresh[key].splitlines(True)
+      continue
+    j = i
+    while j < len(fingerprints) and fingerprints[j][2] not in cache:
+      j += 1
+    run = fingerprints[i:j]
+    for (_, _, key), patch in zip(run, iter_format_commits(repo, run)):
+      fresh[key] = ''.join(patch)
+      yield patch
+    i = j
+  sys.stderr.write(
+    f"Reused {reused} cached patches, formatted {len(fingerprints) - reused}\n"
+  )
+  save_export_cache(cache_path, salt, fresh)
+
+
+def iter_split_patches(lines):
+  """Split an iterable of lines holding a series of patches into one list of
+  lines per patch, yielding each patch as soon as the next one starts."""
+  patch_start = re.compile('^From [0-9a-f]+ ')
+  patch = None
+  for line in lines:
+    if patch_start.match(line):
+      if patch is not None:
+        yield patch
+      patch = []
+    if patch is not None:
+      patch.append(line)
+  if patch is not None:
+    yield patch
+
+
 def split_patches(patch_data):
   """Split a concatenated series of patches into N separate patches"""
-  patches = []
-  patch_start = re.compile('^From [0-9a-f]+ ')
   # Keep line endings in case any patches target files with CRLF.
   keep_line_endings = True
-  for line in patch_data.splitlines(keep_line_endings):
-    if patch_start.match(line):
-      patches.append([])
-    patches[-1].append(line)
-  return patches
+  return list(iter_split_patches(patch_data.splitlines(keep_line_endings)))
 
 def filter_patches(patches, key):
   """Return patches that include the specified key"""
@@ -206,24 +1297,58 @@ def join_patch(patch):
 
 
 def remove_patch_location(patch):
-  """Strip out the patch location lines from a patch's message body"""
-  force_keep_next_line = False
-  n = len(patch)
-  for i, l in enumerate(patch):
-    skip_line = is_patch_location_line(l)
-    skip_next = i < n - 1 and is_patch_location_line(patch[i + 1])
-    if not force_keep_next_line and (
-      skip_line or (skip_next and len(l.rstrip()) == 0)
-    ):
-      pass  # drop this line
-    else:
-      yield l
-    force_keep_next_line = l.startswith('Subject: ')
+  """Strip out the patch location lines from a patch's message body. |patch|
+  may be any iterable of lines; only one line of lookahead is kept."""
+  force_keep_line = False
+  pending = None
+  for l in patch:
+    if pending is not None:
+      skip_line = is_patch_location_line(pending)
+      skip_next = is_patch_location_line(l)
+      if force_keep_line or not (
+        skip_line or (skip_next and len(pending.rstrip()) == 0)
+      ):
+        yield pending
+      force_keep_line = pending.startswith('Subject: ')
+    pending = l
+  if pending is not None and (
+    force_keep_line or not is_patch_location_line(pending)
+  ):
+    yield pending
+
+
+def write_if_changed(path, data):
+  """Write |data| to |path| unless the file already holds exactly that, so
+  untouched files keep their mtime. Returns True if the file was written."""
+  try:
+    if os.path.getsize(path) == len(data):
+      with io.open(path, 'rb') as f:
+        if f.read() == data:
+          return False
+  except FileNotFoundError:
+    pass
+  with io.open(path, 'wb') as f:
+    f.write(data)
+  return True
 
 
 def export_patches(repo, out_dir,
                    patch_range=None, ref=UPSTREAM_HEAD,
-                   dry_run=False, grep=None):
+                   dry_run=False, grep=None, only_changed=False,
+                   use_cache=False, file_names=None):
+  """Export the commits in |patch_range| as patch files in |out_dir|. With
+  |dry_run|, nothing is written; instead, the names of the files in |out_dir|
+  that are out of date are printed and returned.
+
+  Like |grep|, |file_names| limits the export to some of the patches: those
+  that will be written to one of the given file names. Only the selected
+  commits are formatted, and only their files are written: the .patches list
+  and the other patches in |out_dir| are kept as they are.
+
+  With |only_changed|, files whose content is already up to date are left
+  alone, and a summary of written, unchanged and removed patches is
+  printed. |use_cache| reuses previously formatted output for commits that
+  did not change; see iter_exported_patches()."""
   if not os.path.exists(repo):
     sys.stderr.write(
       f"Skipping patches in {repo} because it does not exist.\n"
@@ -233,57 +1358,109 @@ def export_patches(repo, out_dir,
     patch_range, n_patches = guess_base_commit(repo, ref)
     msg = f"Exporting {n_patches} patches in {repo} since {patch_range[0:7]}\n"
     sys.stderr.write(msg)
-  patch_data = format_patch(repo, patch_range)
-  patches = split_patches(patch_data)
+  # Patches are formatted, split and written one at a time as git produces
+  # them, so memory use doesn't grow with the size of the series.
+  counts = [0, 0]
+  if file_names is not None:
+    patches = iter_selected_patches(repo, patch_range, file_names, counts)
+  else:
+    patches = iter_exported_patches(repo, patch_range, use_cache)
   if grep:
-    olen = len(patches)
-    patches = filter_patches(patches, grep)
-    sys.stderr.write(f"Exporting {len(patches)} of {olen} patches\n")
+    grep_counts = [0, 0]
+    def grep_patches(patches):
+      for patch in patches:
+        grep_counts[1] += 1
+        if filter_patches([patch], grep):
+          grep_counts[0] += 1
+          yield patch
+    patches = grep_patches(patches)
 
   try:
     os.mkdir(out_dir)
   except OSError:
     pass
 
+  stale = None
   if dry_run:
     # If we're doing a dry run, iterate through each patch and see if the newly
-    # exported patch differs from what exists. Report number of mismatched
-    # patches and fail if there's more than one.
+    # exported patch differs from what exists. Report and return the
+    # mismatched patches, including ones that would be added or removed.
     bad_patches = []
+    filenames = []
     for patch in patches:
       filename = get_file_name(patch)
+      filenames.append(filename)
       filepath = posixpath.join(out_dir, filename)
-      with io.open(filepath, 'rb') as inp:
-        existing_patch = str(inp.read(), 'utf-8')
+      try:
+        with io.open(filepath, 'rb') as inp:
+          existing_patch = str(inp.read(), 'utf-8')
+      except FileNotFoundError:
+        existing_patch = None
       formatted_patch = join_patch(patch)
       if formatted_patch != existing_patch:
         bad_patches.append(filename)
+    if not grep and file_names is None:
+      bad_patches += sorted(
+        p for p in os.listdir(out_dir)
+        if p.endswith('.patch') and p not in filenames
+      )
+      patch_list = ''.join(filename + '\n' for filename in filenames)
+      try:
+        with io.open(posixpath.join(out_dir, '.patches'), 'r',
+                     encoding='utf-8', newline='') as inp:
+          existing_patch_list = inp.read()
+      except FileNotFoundError:
+        existing_patch_list = None
+      if patch_list != existing_patch_list:
+        bad_patches.append('.patches')
     if len(bad_patches) > 0:
       sys.stderr.write(
         "Patches in {} not up to date: {} patches need update\n-- {}\n".format(
           out_dir, len(bad_patches), "\n-- ".join(bad_patches)
         )
       )
-      sys.exit(1)
+    stale = bad_patches
   else:
-    # Remove old patches so that deleted commits are correctly reflected in the
-    # patch files (as a removed file)
-    for p in os.listdir(out_dir):
-      if p.endswith('.patch'):
-        os.remove(posixpath.join(out_dir, p))
-    with io.open(
-      posixpath.join(out_dir, '.patches'),
-      'w',
-      newline='\n',
-      encoding='utf-8',
-    ) as pl:
-      for patch in patches:
-        filename = get_file_name(patch)
-        file_path = posixpath.join(out_dir, filename)
-        formatted_patch = join_patch(patch)
+    filenames = []
+    written = 0
+    for patch in patches:
+      filename = get_file_name(patch)
+      file_path = posixpath.join(out_dir, filename)
+      formatted_patch = join_patch(patch).encode('utf-8')
+      if only_changed:
+        written += write_if_changed(file_path, formatted_patch)
+      else:
         # Write in binary mode to retain mixed line endings on write.
         with io.open(
           file_path, 'wb'
         ) as f:
-          f.write(formatted_patch.encode('utf-8'))
-        pl.write(filename + '\n')
+          f.write(formatted_patch)
+      filenames.append(filename)
+    removed = 0
+    # A selection by file name is written into the existing series, so the
+    # patch list and the patches that were not selected are left alone.
+    if file_names is None:
+      patch_list = ''.join(filename + '\n' for filename in filenames)
+      patch_list_path = posixpath.join(out_dir, '.patches')
+      if only_changed:
+        write_if_changed(patch_list_path, patch_list.encode('utf-8'))
+      else:
+        with io.open(patch_list_path, 'w', newline='\n',
+                     encoding='utf-8') as pl:
+          pl.write(patch_list)
+      # Remove old patches so that deleted commits are correctly reflected in
+      # the patch files (as a removed file)
+      for p in os.listdir(out_dir):
+        if p.endswith('.patch') and p not in filenames:
+          os.remove(posixpath.join(out_dir, p))
+          removed += 1
+    if only_changed:
+      sys.stderr.write(
+        f"Patches in {out_dir}: {written} written, "
+        f"{len(filenames) - written} unchanged, {removed} removed\n"
+      )
+  if grep or file_names is not None:
+    exported = grep_counts[0] if grep else counts[0]
+    total = counts[1] if file_names is not None else grep_counts[1]
+    sys.stderr.write(f"Exported {exported} of {total} patches\n")
+  return stale
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""Check that the fast-import engine creates the same commits as 'git am', that
+exporting part of a series leaves the rest alone, and that patching a partial
+clone fetches the blobs it needs in one request."""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import git
+from patches import patch_lines_from_dir, patch_series_digest
+
+TEXT = b''.join(b'line %d\n' % i for i in range(1, 41))
+
+
+class ImportEnginesTest(unittest.TestCase):
+  object_format = 'sha1'
+
+  def setUp(self):
+    self.repo = tempfile.mkdtemp(prefix='git-test-')
+    self.addCleanup(shutil.rmtree, self.repo)
+    self.git('init', '-q', '--object-format=' + self.object_format)
+    self.git('config', 'user.name', 'Git Test')
+    self.git('config', 'user.email', 'git-test@example.com')
+    self.git('config', 'core.autocrlf', 'false')
+    self.addCleanup(git.close_sessions)
+
+  def git(self, *args, env=None):
+    return subprocess.run(['git', *args], cwd=self.repo, check=True, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+  def write_file(self, path, content):
+    full_path = os.path.join(self.repo, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'wb') as f:
+      f.write(content)
+    self.git('add', path)
+
+  def commit(self, message, author, date):
+    env = dict(os.environ, GIT_AUTHOR_NAME=author[0],
+               GIT_AUTHOR_EMAIL=author[1], GIT_AUTHOR_DATE=date)
+    self.git('commit', '-q', '-m', message, env=env)
+
+  def make_series(self):
+    """Commit a base and a short series on top of it, then reset to the base
+    and return the series as 'git format-patch' writes it."""
+    self.write_file('a.txt', TEXT)
+    self.write_file('dir/b.txt', TEXT)
+    self.git('commit', '-q', '-m', 'base')
+    base = git.get_commit_for_ref(self.repo, 'HEAD')
+
+    self.write_file('a.txt', TEXT.replace(b'line 20\n', b'line twenty\n'))
+    self.commit('Change a line\n\nWith a body that spans\ntwo lines.\n\n'
+                'Bug: 1234\nSigned-off-by: Someone <someone@example.com>\n',
+                ('Some Author', 'author@example.com'),
+                '2020-01-02T03:04:05+0530')
+    self.write_file('dir/c.txt', TEXT)
+    self.git('rm', '-q', 'dir/b.txt')
+    self.commit('Add c and remove b',
+                ('Ünïcödé Author', 'unicode@example.com'),
+                '2021-06-07T08:09:10-0700')
+    self.write_file('a.txt', TEXT.replace(b'line 1\n', b'line 1\r\n'))
+    self.commit('Use a CRLF in a\n\nChange-Id: I0123456789abcdef\n',
+                ('Some Author', 'author@example.com'),
+                '2022-11-12T13:14:15+0000')
+
+    series = self.git('format-patch', '--stdout', '--full-index',
+                      base + '..HEAD').stdout.decode('utf-8')
+    self.git('reset', '-q', '--hard', base)
+    return series
+
+  def test_fast_import_matches_am(self):
+    series = self.make_series()
+    with tempfile.TemporaryFile() as output:
+      results = git.benchmark_import_engines(self.repo, series, output=output)
+    _, am_commits = results['am']
+    _, fast_import_commits = results['fast-import']
+    self.assertIsNotNone(am_commits)
+    self.assertEqual(len(am_commits), 3)
+    self.assertEqual(fast_import_commits, am_commits)
+    for tree, _, _ in am_commits:
+      self.assertRegex(tree, '^[0-9a-f]{40}([0-9a-f]{24})?$')
+    self.assertIn('Signed-off-by: Someone <someone@example.com>',
+                  am_commits[0][2])
+    self.assertIn('Ünïcödé Author', am_commits[1][1])
+
+  def test_fast_import_leaves_am_session_at_failing_patch(self):
+    series = self.make_series()
+    self.write_file('dir/c.txt', b'in the way\n')
+    self.git('commit', '-q', '-m', 'conflicting base')
+    base = git.get_commit_for_ref(self.repo, 'HEAD')
+    report = {}
+    with tempfile.TemporaryFile() as output:
+      with self.assertRaises(RuntimeError):
+        git.import_patches(self.repo, engine='fast-import',
+                           patch_data=series, report=report, output=output)
+    subjects = self.git('log', '--format=%s', base + '..HEAD').stdout
+    self.assertEqual(subjects, b'Change a line\n')
+    current = self.git('am', '--show-current-patch=raw').stdout
+    self.assertIn(b'Subject: [PATCH 2/3] Add c and remove b', current)
+    seconds = [patch['seconds'] for patch in report['patches']]
+    self.assertEqual(len(seconds), 3)
+    self.assertIsNone(seconds[2])
+    self.git('am', '--abort')
+
+  def test_patch_times_add_up(self):
+    self.write_file('a.txt', TEXT)
+    self.git('commit', '-q', '-m', 'base')
+    base = git.get_commit_for_ref(self.repo, 'HEAD')
+    for number in range(40):
+      self.write_file('a.txt', TEXT + b'change %d\n' % number)
+      self.git('commit', '-q', '-m', f'Change {number}')
+    series = self.git('format-patch', '--stdout', base + '..HEAD').stdout
+    self.git('reset', '-q', '--hard', base)
+    report = {}
+    with tempfile.TemporaryFile() as output:
+      git.import_patches(self.repo, patch_data=series.decode('utf-8'),
+                         report=report, output=output)
+    seconds = [patch['seconds'] for patch in report['patches']]
+    self.assertEqual(len(seconds), 40)
+    self.assertNotIn(None, seconds)
+    self.assertLessEqual(sum(seconds), report['seconds'])
+    self.assertGreater(sum(seconds), report['seconds'] * 0.6)
+
+  def test_patched_tree_cache_is_per_patch_dir(self):
+    series = self.make_series()
+    base = git.get_commit_for_ref(self.repo, 'HEAD')
+    patch_dirs = []
+    for name in ('one', 'two'):
+      patch_dir = os.path.join(self.repo, '.git', name)
+      os.mkdir(patch_dir)
+      with open(os.path.join(patch_dir, '0001-series.patch'), 'w',
+                encoding='utf-8', newline='') as f:
+        f.write(series)
+      with open(os.path.join(patch_dir, '.patches'), 'w',
+                encoding='utf-8') as f:
+        f.write('0001-series.patch\n')
+      patch_dirs.append(patch_dir)
+    for expect_restored in (False, True):
+      for patch_dir in patch_dirs:
+        self.git('reset', '-q', '--hard', base)
+        with tempfile.TemporaryFile() as output:
+          restored = git.import_patches(
+            self.repo, cache_key=patch_series_digest(patch_dir),
+            patch_data=patch_lines_from_dir(patch_dir), patch_dir=patch_dir,
+            output=output)
+        self.assertEqual(restored, expect_restored)
+        log = self.git('log', '--format=%B', base + '..HEAD').stdout
+        self.assertIn(f'Patch-Dir: {patch_dir}\n', log.decode('utf-8'))
+
+  def test_fast_import_refuses_threeway_fallback(self):
+    series = self.make_series()
+    head = git.get_commit_for_ref(self.repo, 'HEAD')
+    for kwargs in ({'threeway': git.THREEWAY_FALLBACK}, {'fallbacks': []}):
+      with self.assertRaises(ValueError):
+        git.import_patches(self.repo, engine='fast-import', patch_data=series,
+                           **kwargs)
+      self.assertEqual(git.get_commit_for_ref(self.repo, 'HEAD'), head)
+
+
+class Sha256ImportEnginesTest(ImportEnginesTest):
+  object_format = 'sha256'
+
+
+class ExportPatchesTest(unittest.TestCase):
+  def setUp(self):
+    self.repo = tempfile.mkdtemp(prefix='git-test-')
+    self.addCleanup(shutil.rmtree, self.repo)
+    self.out_dir = os.path.join(self.repo, 'patches')
+    self.git('init', '-q')
+    self.git('config', 'user.name', 'Git Test')
+    self.git('config', 'user.email', 'git-test@example.com')
+
+  def git(self, *args):
+    return subprocess.run(['git', *args], cwd=self.repo, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+  def read_out_dir(self):
+    files = {}
+    for name in os.listdir(self.out_dir):
+      with open(os.path.join(self.out_dir, name), 'rb') as f:
+        files[name] = f.read()
+    return files
+
+  def test_export_selected_patches_into_series(self):
+    self.git('commit', '-q', '--allow-empty', '-m', 'base')
+    base = git.get_commit_for_ref(self.repo, 'HEAD')
+    for name in ('a', 'b', 'c'):
+      with open(os.path.join(self.repo, name + '.txt'), 'wb') as f:
+        f.write(TEXT)
+      self.git('add', name + '.txt')
+      self.git('commit', '-q', '-m', 'Change ' + name)
+    git.export_patches(self.repo, self.out_dir, patch_range=base + '..HEAD')
+    exported = self.read_out_dir()
+    self.assertEqual(exported['.patches'],
+                     b'change_a.patch\nchange_b.patch\nchange_c.patch\n')
+
+    stale = dict(exported, **{'change_b.patch': b'stale\n',
+                               'change_c.patch': b'stale\n'})
+    for name, content in stale.items():
+      with open(os.path.join(self.out_dir, name), 'wb') as f:
+        f.write(content)
+    for only_changed in (False, True):
+      git.export_patches(self.repo, self.out_dir,
+                         patch_range=base + '..HEAD',
+                         only_changed=only_changed,
+                         file_names={'change_b.patch'})
+      self.assertEqual(self.read_out_dir(),
+                       dict(stale, **{'change_b.patch':
+                                      exported['change_b.patch']}))
+
+
+class PrefetchTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='git-test-')
+    self.addCleanup(shutil.rmtree, self.tmp)
+    self.addCleanup(git.close_sessions)
+    self.upstream = os.path.join(self.tmp, 'upstream')
+    self.clone = os.path.join(self.tmp, 'clone')
+    self.trace = os.path.join(self.tmp, 'trace.json')
+
+  def git(self, *args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd or self.upstream,
+                          check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+
+  def make_upstream(self):
+    """Create an upstream with a few files and return a patch changing two of
+    them."""
+    os.mkdir(self.upstream)
+    self.git('init', '-q')
+    self.git('config', 'user.name', 'Git Test')
+    self.git('config', 'user.email', 'git-test@example.com')
+    self.git('config', 'uploadpack.allowFilter', 'true')
+    self.git('config', 'uploadpack.allowAnySHA1InWant', 'true')
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+      with open(os.path.join(self.upstream, name), 'wb') as f:
+        f.write(name.encode() + b'\n' + TEXT)
+    self.git('add', '-A')
+    self.git('commit', '-q', '-m', 'base')
+    for name in ('a.txt', 'b.txt'):
+      with open(os.path.join(self.upstream, name), 'ab') as f:
+        f.write(b'changed\n')
+    self.git('commit', '-q', '-a', '-m', 'change')
+    patch = self.git('format-patch', '--stdout', '--full-index', '-1')
+    self.git('reset', '-q', '--hard', 'HEAD~')
+    return patch.stdout.decode('utf-8')
+
+  def count_fetches(self):
+    """Count the 'git fetch' processes started since the trace was enabled,
+    lazy fetches of missing objects included."""
+    if not os.path.exists(self.trace):
+      return 0
+    with open(self.trace, encoding='utf-8') as f:
+      events = [json.loads(line) for line in f]
+    return sum(1 for event in events
+               if event['event'] == 'cmd_name' and event['name'] == 'fetch')
+
+  def test_prefetch_fetches_missing_blobs_at_once(self):
+    patch = self.make_upstream()
+    self.git('clone', '-q', '--no-checkout', '--filter=blob:none',
+             'file://' + self.upstream, self.clone, cwd=self.tmp)
+    self.assertEqual(git.get_promisor_remote(self.clone), 'origin')
+    with mock.patch.dict(os.environ, {'GIT_TRACE2_EVENT': self.trace}), \
+         tempfile.TemporaryFile() as output:
+      wanted = git.get_preimage_objects(self.clone, patch, 'HEAD')
+      self.assertEqual(len(wanted), 2)
+      self.assertEqual(self.count_fetches(), 0)
+      self.assertEqual(git.get_missing_objects(self.clone, sorted(wanted)),
+                       wanted)
+      self.assertEqual(self.count_fetches(), 0)
+      self.assertEqual(
+        git.prefetch_preimages(self.clone, 'origin', patch, output=output), 2)
+      self.assertEqual(self.count_fetches(), 1)
+      self.assertEqual(git.get_missing_objects(self.clone, sorted(wanted)),
+                       set())
+
+
+if __name__ == '__main__':
+  unittest.main()
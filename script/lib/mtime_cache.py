@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+"""Keeps the mtimes of files whose content a sync leaves unchanged.
+
+The mtime cache of patched files maps file paths to dicts that may hold the
+file's 'sha256' (raw bytes), its 'atime_ns' and 'mtime_ns', and its 'stat'
+signature. On disk it is a little-endian binary file:
+
+  header   magic, version, directory count, entry count, string table size
+  dirs     (offset, length) of each directory in the string table
+  entries  one fixed-size record per file: directory number, (offset,
+           length) of the file name in the string table, flags, digest,
+           atime, mtime and stat signature
+  strings  UTF-8 directory and file names
+
+so loading it is a couple of struct.iter_unpack() calls. Caches written as
+JSON by earlier versions are read transparently.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import posixpath
+import struct
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+import git
+from patch_index import patched_file_paths
+
+MAGIC = b'EMTC'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHIII')
+DIRECTORY = struct.Struct('<II')
+ENTRY = struct.Struct('<IIHH32sqqQQqq')
+
+HAS_DIGEST = 1
+HAS_TIMES = 2
+HAS_STAT = 4
+
+NO_DIGEST = bytes(32)
+NO_STAT = (0, 0, 0, 0)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def legacy_path(path):
+  """Where earlier versions kept the cache that is now at |path|."""
+  return os.path.splitext(path)[0] + '.json'
+
+
+def encode(cache):
+  strings = bytearray()
+  offsets = {}
+
+  def add_string(s):
+    if s not in offsets:
+      offsets[s] = (len(strings), len(strings) + len(s.encode('utf-8')))
+      strings.extend(s.encode('utf-8'))
+    start, end = offsets[s]
+    return start, end - start
+
+  directories = {}
+  entries = []
+  for path, metadata in sorted(cache.items()):
+    directory, name = posixpath.split(path)
+    if directory not in directories:
+      directories[directory] = (len(directories), add_string(directory))
+    name_offset, name_length = add_string(name)
+    flags = 0
+    digest = metadata.get('sha256')
+    if digest is not None:
+      flags |= HAS_DIGEST
+    if 'mtime_ns' in metadata:
+      flags |= HAS_TIMES
+    if metadata.get('stat') is not None:
+      flags |= HAS_STAT
+    entries.append(ENTRY.pack(
+      directories[directory][0], name_offset, name_length, flags,
+      digest or NO_DIGEST, metadata.get('atime_ns', 0),
+      metadata.get('mtime_ns', 0), *(metadata.get('stat') or NO_STAT)
+    ))
+
+  return b''.join([
+    HEADER.pack(MAGIC, VERSION, 0, len(directories), len(entries),
+                len(strings)),
+    *(DIRECTORY.pack(*location) for _, location in directories.values()),
+    *entries,
+    bytes(strings),
+  ])
+
+
+def decode(data):
+  if len(data) < HEADER.size:
+    raise ValueError('truncated mtime cache')
+  magic, version, _, directory_count, entry_count, strings_size = \
+      HEADER.unpack_from(data)
+  if magic != MAGIC:
+    raise ValueError('not an mtime cache')
+  if version != VERSION:
+    raise ValueError(f'unsupported mtime cache version {version}')
+  entries_start = HEADER.size + directory_count * DIRECTORY.size
+  strings_start = entries_start + entry_count * ENTRY.size
+  if len(data) != strings_start + strings_size:
+    raise ValueError('truncated mtime cache')
+  strings = data[strings_start:]
+  directories = [
+    strings[offset:offset + length].decode('utf-8')
+    for offset, length in DIRECTORY.iter_unpack(
+      data[HEADER.size:entries_start])
+  ]
+
+  cache = {}
+  for (directory, name_offset, name_length, flags, digest, atime_ns,
+       mtime_ns, *stat) in ENTRY.iter_unpack(data[entries_start:strings_start]):
+    name = strings[name_offset:name_offset + name_length].decode('utf-8')
+    metadata = {}
+    if flags & HAS_DIGEST:
+      metadata['sha256'] = digest
+    if flags & HAS_TIMES:
+      metadata['atime_ns'] = atime_ns
+      metadata['mtime_ns'] = mtime_ns
+    if flags & HAS_STAT:
+      metadata['stat'] = stat
+    cache[posixpath.join(directories[directory], name)] = metadata
+  return cache
+
+
+def from_json(data):
+  """Convert a cache written as JSON by earlier versions, with hex digests
+  and times in seconds."""
+  cache = {}
+  for path, entry in json.loads(data).items():
+    metadata = {}
+    if 'sha256' in entry:
+      metadata['sha256'] = bytes.fromhex(entry['sha256'])
+    if 'mtime' in entry:
+      metadata['atime_ns'] = round(entry['atime'] * 1e9)
+      metadata['mtime_ns'] = round(entry['mtime'] * 1e9)
+    if 'stat' in entry:
+      metadata['stat'] = entry['stat']
+    cache[path] = metadata
+  return cache
+
+
+def read_cache(path):
+  """Load the cache at |path|, in either format. Raises OSError if it does
+  not exist and ValueError if it is damaged."""
+  with open(path, 'rb') as f:
+    data = f.read()
+  if data.startswith(MAGIC):
+    return decode(data)
+  return from_json(data)
+
+
+def write_cache(path, cache):
+  with open(path + '.tmp', 'wb') as f:
+    f.write(encode(cache))
+  os.replace(path + '.tmp', path)
+
+
+def stat_signature(st):
+  """Changes whenever the file's content may have: ctime can't be set, so
+  a file can't be rewritten and have its times put back unnoticed."""
+  return [st.st_size, st.st_ino, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def hash_file(file_path):
+  digest = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.digest()
+
+
+def hash_files(file_paths):
+  """Return {file_path: sha256} for |file_paths|, hashed across a thread
+  pool. hashlib releases the GIL while hashing, so this uses every core."""
+  with ThreadPoolExecutor() as executor:
+    return dict(zip(file_paths, executor.map(hash_file, file_paths)))
+
+
+def digest_file_path(cache_file):
+  return cache_file + '.digests'
+
+
+def find_cache_file(cache_file):
+  """Return |cache_file|, or the JSON cache an earlier version left next
+  to it, if either exists."""
+  for path in (cache_file, legacy_path(cache_file)):
+    if os.path.exists(path):
+      return path
+  return None
+
+
+def load_digests(digest_file):
+  """Load the digests recorded by the last apply, keyed by file path."""
+  try:
+    return read_cache(digest_file)
+  except (OSError, ValueError):
+    return {}
+
+
+def save_digests(digest_file, digests):
+  write_cache(digest_file, digests)
+
+
+def generate_cache(patches_config, index, digests=None):
+  """Record the digest, times and stat signature of every patched file.
+  Files whose stat signature matches the one in |digests| aren't hashed
+  again."""
+  digests = digests or {}
+  mtime_cache = {}
+  to_hash = []
+
+  for file_path in patched_file_paths(index, patches_config):
+    if file_path in mtime_cache:
+      # File may be patched multiple times, we don't need to
+      # rehash it since we are looking at the final result
+      continue
+
+    try:
+      st = os.stat(file_path)
+    except FileNotFoundError:
+      print('Skipping non-existent file:', file_path)
+      continue
+
+    metadata = {
+      'atime_ns': st.st_atime_ns,
+      'mtime_ns': st.st_mtime_ns,
+      'stat': stat_signature(st),
+    }
+    known = digests.get(file_path)
+    if known is not None and known.get('stat') == metadata['stat']:
+      metadata['sha256'] = known['sha256']
+    else:
+      to_hash.append(file_path)
+    mtime_cache[file_path] = metadata
+
+  for file_path, digest in hash_files(to_hash).items():
+    mtime_cache[file_path]['sha256'] = digest
+
+  return mtime_cache
+
+
+def apply_mtimes(mtime_cache):
+  """Put back the times of every file whose content is the same as when
+  the cache was generated. Returns the digest and current stat signature
+  of every file, for the next generate_cache() to reuse."""
+  updates = []
+  digests = {}
+  to_hash = []
+
+  for file_path, metadata in mtime_cache.items():
+    try:
+      st = os.stat(file_path)
+    except FileNotFoundError:
+      print('Skipping non-existent file:', file_path)
+      continue
+
+    if metadata.get('stat') == stat_signature(st):
+      # Untouched since the cache was generated, so the content and
+      # times are already what they were.
+      digests[file_path] = {
+        'sha256': metadata['sha256'],
+        'stat': metadata['stat'],
+      }
+    else:
+      to_hash.append(file_path)
+
+  for file_path, digest in hash_files(to_hash).items():
+    metadata = mtime_cache[file_path]
+    if digest == metadata['sha256']:
+      updates.append([file_path, metadata['atime_ns'], metadata['mtime_ns']])
+    digests[file_path] = {'sha256': digest}
+
+  # We can't atomically set the times for all files at once, but by waiting
+  # to update until we've checked all the files we at least have less chance
+  # of only updating some files due to an error on one of the files
+  for [file_path, atime_ns, mtime_ns] in updates:
+    os.utime(file_path, ns=(atime_ns, mtime_ns))
+
+  for file_path in to_hash:
+    try:
+      digests[file_path]['stat'] = stat_signature(os.stat(file_path))
+    except FileNotFoundError:
+      del digests[file_path]
+
+  return digests
+
+
+def config_repos(patches_config):
+  return list(dict.fromkeys(target['repo'] for target in patches_config))
+
+
+def snapshot_times(patches_config):
+  """Record the times and stat signature of every file tracked in the
+  configured repos. The content the files have is kept as a commit in each
+  repo, so nothing needs to be hashed here."""
+  snapshot = {}
+
+  for repo in config_repos(patches_config):
+    if not os.path.isdir(repo):
+      print('Skipping non-existent repo:', repo)
+      continue
+
+    git.update_ref(repo, git.SNAPSHOT_REF, git.snapshot_worktree(repo))
+    for path in git.list_files(repo):
+      file_path = posixpath.join(repo, path)
+      try:
+        st = os.stat(file_path)
+      except FileNotFoundError:
+        continue
+      snapshot[file_path] = {
+        'atime_ns': st.st_atime_ns,
+        'mtime_ns': st.st_mtime_ns,
+        'stat': stat_signature(st),
+      }
+
+  return snapshot
+
+
+def restore_times(patches_config, snapshot, preserve_refs=False):
+  """Put back the times of every file in the configured repos whose content
+  is the same as when the snapshot was taken. git compares the content
+  only for files whose stat changed. Returns how many files were
+  restored."""
+  restored = 0
+
+  for repo in config_repos(patches_config):
+    if not os.path.isdir(repo):
+      continue
+    commit = git.try_get_commit_for_ref(repo, git.SNAPSHOT_REF)
+    if commit is None:
+      print('Skipping repo without a snapshot:', repo)
+      continue
+
+    changed = git.get_changed_files(repo, commit)
+    updates = []
+    for path in git.list_files(repo):
+      file_path = posixpath.join(repo, path)
+      metadata = snapshot.get(file_path)
+      if metadata is None or path in changed:
+        continue
+      try:
+        st = os.stat(file_path)
+      except FileNotFoundError:
+        continue
+      if stat_signature(st) != metadata['stat']:
+        updates.append(
+          [file_path, metadata['atime_ns'], metadata['mtime_ns']])
+
+    for [file_path, atime_ns, mtime_ns] in updates:
+      os.utime(file_path, ns=(atime_ns, mtime_ns))
+    if updates:
+      # Spare the next 'git status' from checking them all again.
+      git.refresh_index(repo)
+    restored += len(updates)
+
+    if not preserve_refs:
+      git.delete_ref(repo, git.SNAPSHOT_REF)
+
+  return restored
+
+
+def split_by_repo(cache, repos):
+  """Split |cache| into {repo: entries} for each of |repos|, putting every
+  file in the innermost repo that contains it."""
+  by_repo = {repo: {} for repo in repos}
+  innermost_first = sorted(repos, key=len, reverse=True)
+  for file_path, metadata in cache.items():
+    for repo in innermost_first:
+      if file_path.startswith(repo.rstrip('/') + '/'):
+        by_repo[repo][file_path] = metadata
+        break
+  return by_repo
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""A persistent index of the files, and the lines within them, that every
+patch touches.
+
+The index is a single JSON file. Patch files are recorded relative to the
+index so that scripts run from different directories can share it, and a
+patch is only parsed again when its size, mtime and content have changed.
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import posixpath
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+from patches import parse_diff, read_patch_list
+
+INDEX_FILE = 'patch-index.json'
+INDEX_VERSION = 3
+
+
+def default_index_path(patches_root):
+  return os.path.join(patches_root, INDEX_FILE)
+
+
+def describe_patch(lines):
+  """Return the files touched by the patch in |lines| as dicts holding the
+  'path' after patching (None if it is deleted), the 'old_path' (None if it
+  is new), whether it is a 'copy' that leaves 'old_path' in place, the
+  blob ids from the 'index' line (None if there is none), whether the
+  change is 'binary' and its 'hunks' as
+  [old_start, old_len, new_start, new_len] lists."""
+  return [
+    {
+      'path': file_patch.new_path,
+      'old_path': file_patch.old_path,
+      'copy': file_patch.is_copy,
+      'old_blob': file_patch.old_blob,
+      'new_blob': file_patch.new_blob,
+      'binary': file_patch.binary is not None,
+      'hunks': [
+        [hunk.old_start, hunk.old_len, hunk.new_start, hunk.new_len]
+        for hunk in file_patch.hunks
+      ],
+    }
+    for file_patch in parse_diff(lines)
+  ]
+
+
+def format_hunk(hunk):
+  old_start, old_len, new_start, new_len = hunk
+  return f'@@ -{old_start},{old_len} +{new_start},{new_len} @@'
+
+
+def hunk_covers(hunk, line):
+  """Whether |hunk| touches |line| of the file before it is applied."""
+  old_start, old_len = hunk[0], hunk[1]
+  return old_start <= line < old_start + max(old_len, 1)
+
+
+class PatchIndex:
+  """The patch index stored at |path|. Call save() to write back any
+  entries that were added or refreshed."""
+
+  def __init__(self, path):
+    self.path = path
+    self.base = os.path.dirname(os.path.abspath(path))
+    self.entries = {}
+    self.dirty = False
+    self.parsed = 0
+    try:
+      with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+      if data.get('version') == INDEX_VERSION:
+        self.entries = data['patches']
+    except (OSError, ValueError, KeyError):
+      pass
+
+  def _key(self, path):
+    return os.path.relpath(os.path.abspath(path), self.base).replace(
+      os.sep, '/'
+    )
+
+  def lookup(self, patch_dir, patch_filename):
+    """Return the files touched by |patch_dir/patch_filename|, parsing the
+    patch only if it changed since it was last indexed."""
+    path = os.path.join(patch_dir, patch_filename)
+    key = self._key(path)
+    entry = self.entries.get(key)
+    st = os.stat(path)
+    if (entry is not None and entry['size'] == st.st_size
+        and entry['mtime_ns'] == st.st_mtime_ns):
+      return entry['files']
+    with open(path, 'rb') as f:
+      data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if entry is None or entry['sha256'] != digest:
+      files = describe_patch(data.decode('utf-8').splitlines(True))
+      self.parsed += 1
+    else:
+      files = entry['files']
+    self.entries[key] = {
+      'size': st.st_size,
+      'mtime_ns': st.st_mtime_ns,
+      'sha256': digest,
+      'files': files,
+    }
+    self.dirty = True
+    return files
+
+  def series(self, patch_dir):
+    """Return (patch_filename, files) for every patch listed in
+    |patch_dir|'s .patches file, in order. Entries for patches that are no
+    longer in the series are dropped."""
+    series = [
+      (patch_filename, self.lookup(patch_dir, patch_filename))
+      for patch_filename in read_patch_list(patch_dir)
+    ]
+    prefix = self._key(patch_dir) + '/'
+    current = {prefix + patch_filename for patch_filename, _ in series}
+    for key in list(self.entries):
+      if key.startswith(prefix) and key not in current:
+        del self.entries[key]
+        self.dirty = True
+    return series
+
+  def save(self):
+    if not self.dirty:
+      return
+    with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+      json.dump({'version': INDEX_VERSION, 'patches': self.entries}, f,
+                sort_keys=True)
+    os.replace(self.path + '.tmp', self.path)
+    self.dirty = False
+
+
+def patched_file_paths(index, patches_config):
+  """Yield the path of every file that is left in place by a patch in
+  |patches_config|, joined to the target's repo. Files touched by several
+  patches are yielded more than once."""
+  for target in patches_config:
+    repo = target.get('repo')
+    for _, files in index.series(target.get('patch_dir')):
+      for patched_file in files:
+        if patched_file['path'] is not None:
+          yield posixpath.join(repo, patched_file['path'])
+
+
+def path_matches(patched_file, pattern, repo=None):
+  """Whether either side of |patched_file| matches the glob |pattern|,
+  relative to the repo or, when |repo| is given, joined to it."""
+  for path in (patched_file['path'], patched_file['old_path']):
+    if path is None:
+      continue
+    if fnmatch.fnmatchcase(path, pattern):
+      return True
+    if repo is not None and fnmatch.fnmatchcase(
+        posixpath.join(repo, path), pattern):
+      return True
+  return False
+
+
+def find_patches(index, patches_config, pattern, line=None):
+  """Yield (target, patch_filename, position, patched_file, hunks) for every
+  patch touching a file that matches |pattern|. |position| is the patch's
+  1-based place in its series. With |line|, only patches with a hunk
+  covering that line of the file they are applied to are included."""
+  for target in patches_config:
+    repo = target.get('repo')
+    series = index.series(target.get('patch_dir'))
+    for position, (patch_filename, files) in enumerate(series, 1):
+      for patched_file in files:
+        if not path_matches(patched_file, pattern, repo):
+          continue
+        hunks = patched_file['hunks']
+        if line is not None:
+          hunks = [hunk for hunk in hunks if hunk_covers(hunk, line)]
+          if not hunks:
+            continue
+        yield target, patch_filename, position, patched_file, hunks
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
-import codecs
+import base64
+import hashlib
 import os
+import re
+import zlib
 
 PATCH_DIR_PREFIX = "Patch-Dir: "
 PATCH_FILENAME_PREFIX = "Patch-Filename: "
@@ -11,30 +14,291 @@ PATCH_LINE_PREFIXES = (PATCH_DIR_PREFIX, PATCH_FILENAME_PREFIX)
 def is_patch_location_line(line):
   return line.startswith(PATCH_LINE_PREFIXES)
 
-def read_patch(patch_dir, patch_filename):
-  """Read a patch from |patch_dir/filename| and amend the commit message with
-  metadata about the patch file it came from."""
-  ret = []
+def read_patch_lines(patch_dir, patch_filename):
+  """Yield the lines of |patch_dir/filename|, amending the commit message with
+  metadata about the patch file it came from. Line endings are preserved."""
   added_patch_location = False
   patch_path = os.path.join(patch_dir, patch_filename)
-  with codecs.open(patch_path, encoding='utf-8') as f:
-    for l in f.readlines():
+  with open(patch_path, encoding='utf-8', newline='') as f:
+    for l in f:
       line_has_correct_start = l.startswith('diff -') or l.startswith('---')
       if not added_patch_location and line_has_correct_start:
-        ret.append(f'{PATCH_DIR_PREFIX}{patch_dir}\n')
-        ret.append(f'{PATCH_FILENAME_PREFIX}{patch_filename}\n')
+        yield f'{PATCH_DIR_PREFIX}{patch_dir}\n'
+        yield f'{PATCH_FILENAME_PREFIX}{patch_filename}\n'
         added_patch_location = True
-      ret.append(l)
-  return ''.join(ret)
+      yield l
+
+
+def read_patch(patch_dir, patch_filename):
+  """Read a patch from |patch_dir/filename| and amend the commit message with
+  metadata about the patch file it came from."""
+  return ''.join(read_patch_lines(patch_dir, patch_filename))
+
+
+def read_patch_list(patch_dir):
+  with open(os.path.join(patch_dir, ".patches"), encoding='utf-8') as file_in:
+    return [line.rstrip('\n') for line in file_in]
+
+
+def patch_lines_from_dir(patch_dir):
+  """Yield a directory of patches line by line in a format suitable for
+  passing to 'git am', without holding the whole series in memory."""
+  for patch_filename in read_patch_list(patch_dir):
+    yield from read_patch_lines(patch_dir, patch_filename)
 
 
 def patch_from_dir(patch_dir):
   """Read a directory of patches into a format suitable for passing to
   'git am'"""
-  with open(os.path.join(patch_dir, ".patches"), encoding='utf-8') as file_in:
-    patch_list = [line.rstrip('\n') for line in file_in.readlines()]
+  return ''.join(patch_lines_from_dir(patch_dir))
+
+
+def patch_series_digest(patch_dir):
+  """Return a digest of the series in |patch_dir|: the '.patches' list and the
+  raw bytes of every patch file it names, in order."""
+  digest = hashlib.sha256()
+  with open(os.path.join(patch_dir, ".patches"), 'rb') as file_in:
+    patch_list = file_in.read()
+  digest.update(patch_list)
+  for patch_filename in patch_list.decode('utf-8').splitlines():
+    with open(os.path.join(patch_dir, patch_filename), 'rb') as f:
+      digest.update(f"\0{patch_filename}\0".encode('utf-8'))
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+GIT_BINARY_PATCH = 'GIT binary patch'
+PATCH_START = re.compile('^From [0-9a-f]{40}(?:[0-9a-f]{24})? ')
+
+
+def iter_patch_stats(lines, stats):
+  """Pass the |lines| of a patch series through unchanged, appending a dict
+  to |stats| for every patch as it goes by. Each dict holds the patch's file
+  name (if the series came from patch_lines_from_dir()), its subject, its
+  size in bytes and the number of files, hunks and binary files in it."""
+  if isinstance(lines, str):
+    lines = lines.splitlines(True)
+  patch = None
+  for line in lines:
+    if PATCH_START.match(line):
+      patch = {
+        'patch': None,
+        'subject': None,
+        'bytes': 0,
+        'files': 0,
+        'hunks': 0,
+        'binary_files': 0,
+      }
+      stats.append(patch)
+    if patch is not None:
+      patch['bytes'] += len(line.encode('utf-8'))
+      if line.startswith('diff --git '):
+        patch['files'] += 1
+      elif line.startswith('@@ '):
+        patch['hunks'] += 1
+      elif line.startswith(GIT_BINARY_PATCH):
+        patch['binary_files'] += 1
+      elif patch['subject'] is None and line.startswith('Subject: '):
+        patch['subject'] = line[len('Subject: '):].rstrip('\r\n')
+      elif patch['patch'] is None and line.startswith(PATCH_FILENAME_PREFIX):
+        patch['patch'] = line[len(PATCH_FILENAME_PREFIX):].rstrip('\r\n')
+    yield line
+
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class PatchParseError(RuntimeError):
+  """Raised when a diff can't be parsed."""
+
+
+class Hunk:
+  """A single '@@' hunk. |lines| holds (tag, bytes) pairs where tag is one of
+  ' ', '-' or '+' and the bytes keep their line ending, if any."""
+  def __init__(self, old_start, old_len, new_start, new_len):
+    self.old_start = old_start
+    self.old_len = old_len
+    self.new_start = new_start
+    self.new_len = new_len
+    self.lines = []
+
+
+class FilePatch:
+  """The part of a git diff that touches a single file."""
+  def __init__(self):
+    self.old_path = None
+    self.new_path = None
+    self.old_mode = None
+    self.new_mode = None
+    self.old_blob = None
+    self.new_blob = None
+    self.is_new = False
+    self.is_delete = False
+    self.is_rename = False
+    self.is_copy = False
+    self.binary = None
+    self.hunks = []
+
+  @property
+  def path(self):
+    return self.new_path if self.new_path is not None else self.old_path
+
+
+def unquote_path(path):
+  """Undo git's C-style quoting of a path in a diff header."""
+  if not path.startswith('"'):
+    return path
+  raw = bytearray()
+  escapes = {'a': 7, 'b': 8, 't': 9, 'n': 10, 'v': 11, 'f': 12, 'r': 13}
+  i = 1
+  while i < len(path) - 1:
+    c = path[i]
+    if c == '\\':
+      n = path[i + 1]
+      if n in escapes:
+        raw.append(escapes[n])
+        i += 2
+      elif n.isdigit():
+        raw.append(int(path[i + 1:i + 4], 8))
+        i += 4
+      else:
+        raw += n.encode('utf-8')
+        i += 2
+    else:
+      raw += c.encode('utf-8')
+      i += 1
+  return raw.decode('utf-8', errors='surrogateescape')
+
+
+def _strip_prefix(path):
+  path = unquote_path(path.rstrip('\r\n').split('\t')[0])
+  if path == '/dev/null':
+    return None
+  return path.split('/', 1)[1] if '/' in path else path
+
+
+def _parse_git_header_names(line):
+  """Return the shared path of a 'diff --git a/X b/X' line, if unambiguous."""
+  names = line[len('diff --git '):].rstrip('\r\n')
+  if names.startswith('"'):
+    return None
+  half = (len(names) - 1) // 2
+  a, b = names[:half], names[half + 1:]
+  if a[2:] == b[2:] and names[half] == ' ':
+    return a[2:]
+  return None
+
+
+def _parse_binary(lines, i, file_patch):
+  """Parse the forward half of a 'GIT binary patch' block."""
+  kind, size = lines[i].split()
+  data = bytearray()
+  i += 1
+  while i < len(lines) and lines[i].strip():
+    line = lines[i].rstrip('\r\n')
+    c = line[0]
+    length = ord(c) - ord('A') + 1 if c <= 'Z' else ord(c) - ord('a') + 27
+    data += base64.b85decode(line[1:])[:length]
+    i += 1
+  data = zlib.decompress(bytes(data))
+  if len(data) != int(size):
+    raise PatchParseError(f'corrupt binary patch for {file_patch.path}')
+  file_patch.binary = (kind, data)
+  # Skip the reverse half, which is only needed to apply the patch backwards.
+  while i < len(lines) and not lines[i].startswith('diff --git '):
+    i += 1
+  return i
+
+
+def parse_diff(lines):
+  """Parse the 'diff --git' sections of a patch into FilePatch objects.
+  |lines| keep their line endings; anything before the first diff header
+  (e.g. the commit message) is ignored."""
+  file_patches = []
+  i = 0
+  n = len(lines)
+  while i < n:
+    line = lines[i]
+    if not line.startswith('diff --git '):
+      i += 1
+      continue
+    file_patch = FilePatch()
+    file_patches.append(file_patch)
+    default_path = _parse_git_header_names(line)
+    i += 1
+    while i < n and not lines[i].startswith(('diff --git ', '@@ ')):
+      line = lines[i].rstrip('\r\n')
+      if line.startswith('old mode '):
+        file_patch.old_mode = line[len('old mode '):]
+      elif line.startswith('new mode '):
+        file_patch.new_mode = line[len('new mode '):]
+      elif line.startswith('deleted file mode '):
+        file_patch.is_delete = True
+        file_patch.old_mode = line[len('deleted file mode '):]
+      elif line.startswith('new file mode '):
+        file_patch.is_new = True
+        file_patch.new_mode = line[len('new file mode '):]
+      elif line.startswith(('rename from ', 'copy from ')):
+        file_patch.is_rename = line.startswith('rename')
+        file_patch.is_copy = not file_patch.is_rename
+        file_patch.old_path = unquote_path(line.split(' ', 2)[2])
+      elif line.startswith(('rename to ', 'copy to ')):
+        file_patch.new_path = unquote_path(line.split(' ', 2)[2])
+      elif line.startswith('index '):
+        blobs, _, mode = line[len('index '):].partition(' ')
+        file_patch.old_blob, file_patch.new_blob = blobs.split('..')
+        if mode:
+          file_patch.old_mode = file_patch.old_mode or mode
+          file_patch.new_mode = file_patch.new_mode or mode
+      elif line.startswith('--- '):
+        file_patch.old_path = _strip_prefix(line[4:])
+      elif line.startswith('+++ '):
+        file_patch.new_path = _strip_prefix(line[4:])
+      elif line.startswith('Binary files '):
+        # No data; the post-image has to come from the object database.
+        file_patch.binary = ('blob', None)
+      elif line == GIT_BINARY_PATCH:
+        i = _parse_binary(lines, i + 1, file_patch)
+        break
+      i += 1
+    if not file_patch.is_new and file_patch.old_path is None:
+      file_patch.old_path = default_path
+    if not file_patch.is_delete and file_patch.new_path is None:
+      file_patch.new_path = default_path
+    while i < n and lines[i].startswith('@@ '):
+      i = _parse_hunk(lines, i, file_patch)
+  return file_patches
+
+
+def _parse_hunk(lines, i, file_patch):
+  match = HUNK_HEADER.match(lines[i])
+  if match is None:
+    raise PatchParseError(f'corrupt hunk header: {lines[i]!r}')
+  old_start, old_len, new_start, new_len = (
+    int(g) if g is not None else 1 for g in match.groups()
+  )
+  hunk = Hunk(old_start, old_len, new_start, new_len)
+  file_patch.hunks.append(hunk)
+  old_left, new_left = old_len, new_len
+  i += 1
+  while i < len(lines) and (old_left > 0 or new_left > 0):
+    line = lines[i]
+    tag = line[0] if line not in ('\n', '\r\n') else ' '
+    content = line[1:] if line not in ('\n', '\r\n') else line
+    if tag == '\\':
+      _strip_last_newline(hunk)
+    elif tag in ' -+':
+      hunk.lines.append((tag, content.encode('utf-8', 'surrogateescape')))
+      old_left -= tag != '+'
+      new_left -= tag != '-'
+    else:
+      break
+    i += 1
+  if i < len(lines) and lines[i].startswith('\\'):
+    _strip_last_newline(hunk)
+    i += 1
+  return i
+
 
-  return ''.join([
-    read_patch(patch_dir, patch_filename)
-    for patch_filename in patch_list
-  ])
+def _strip_last_newline(hunk):
+  tag, content = hunk.lines[-1]
+  hunk.lines[-1] = (tag, content[:-1] if content.endswith(b'\n') else content)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""Check the diff parser used by the patch index, the conflict predictor and
+git-find-failing-patches against the diffs git writes."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(SCRIPT_DIR)
+
+from patches import PatchParseError, parse_diff
+
+TEXT = b''.join(b'line %d\n' % i for i in range(1, 41))
+
+
+def diff_lines(diff):
+  return diff.decode('utf-8', 'surrogateescape').splitlines(True)
+
+
+class PatchesTest(unittest.TestCase):
+  def setUp(self):
+    self.repo = tempfile.mkdtemp(prefix='patches-test-')
+    self.addCleanup(shutil.rmtree, self.repo)
+    self.git('init', '-q')
+    self.git('config', 'user.name', 'Patches Test')
+    self.git('config', 'user.email', 'patches-test@example.com')
+    self.git('config', 'core.autocrlf', 'false')
+
+  def git(self, *args, check=True):
+    return subprocess.run(['git', *args], cwd=self.repo, check=check,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+  def write_files(self, files):
+    """Make the work tree hold exactly |files|, a dict of path to content or
+    to (mode, content)."""
+    self.git('rm', '-r', '-q', '--cached', '--ignore-unmatch', '.')
+    for name in os.listdir(self.repo):
+      if name != '.git':
+        path = os.path.join(self.repo, name)
+        if os.path.isdir(path):
+          shutil.rmtree(path)
+        else:
+          os.unlink(path)
+    for path, entry in files.items():
+      mode, content = entry if isinstance(entry, tuple) else ('100644', entry)
+      full_path = os.path.join(self.repo, path)
+      os.makedirs(os.path.dirname(full_path), exist_ok=True)
+      with open(full_path, 'wb') as f:
+        f.write(content)
+      os.chmod(full_path, 0o755 if mode == '100755' else 0o644)
+    self.git('add', '-A')
+
+  def make_diff(self, before, after, *diff_args):
+    self.write_files(before)
+    self.git('commit', '-q', '--allow-empty', '-m', 'before')
+    self.write_files(after)
+    diff = self.git('diff', '--cached', '--binary', '--full-index',
+                    *diff_args).stdout
+    self.git('reset', '-q', '--hard')
+    return diff
+
+  def blob(self, content):
+    result = subprocess.run(['git', 'hash-object', '--stdin'], cwd=self.repo,
+                            input=content, stdout=subprocess.PIPE, check=True)
+    return result.stdout.decode('ascii').strip()
+
+  def test_modify(self):
+    after = (TEXT.replace(b'line 2\n', b'line two\n')
+                 .replace(b'line 20\n', b'')
+                 .replace(b'line 39\n', b'line 39\nline 39.5\n'))
+    diff = self.make_diff({'a.txt': TEXT}, {'a.txt': after})
+    file_patch, = parse_diff(diff_lines(diff))
+    self.assertEqual((file_patch.old_path, file_patch.new_path),
+                     ('a.txt', 'a.txt'))
+    self.assertEqual((file_patch.old_blob, file_patch.new_blob),
+                     (self.blob(TEXT), self.blob(after)))
+    self.assertEqual(file_patch.old_mode, '100644')
+    self.assertFalse(file_patch.is_new or file_patch.is_delete)
+    self.assertEqual(
+      [(h.old_start, h.old_len, h.new_start, h.new_len)
+       for h in file_patch.hunks],
+      [(1, 5, 1, 5), (17, 7, 17, 6), (37, 4, 36, 5)])
+    preimage = b''.join(l for tag, l in file_patch.hunks[1].lines if tag != '+')
+    self.assertEqual(preimage, b''.join(TEXT.splitlines(True)[16:23]))
+
+  def test_no_newline_at_end_of_file(self):
+    diff = self.make_diff({'a.txt': TEXT}, {'a.txt': TEXT[:-1]})
+    file_patch, = parse_diff(diff_lines(diff))
+    hunk, = file_patch.hunks
+    self.assertEqual(hunk.lines[-2], ('-', b'line 40\n'))
+    self.assertEqual(hunk.lines[-1], ('+', b'line 40'))
+
+  def test_crlf(self):
+    before = TEXT.replace(b'\n', b'\r\n')
+    diff = self.make_diff({'a.txt': before},
+                          {'a.txt': before.replace(b'line 20\r\n',
+                                                   b'line twenty\r\n')})
+    file_patch, = parse_diff(diff_lines(diff))
+    self.assertIn(('+', b'line twenty\r\n'), file_patch.hunks[0].lines)
+
+  def test_new_and_deleted_files(self):
+    diff = self.make_diff({'a.txt': TEXT}, {'b.txt': TEXT, 'c.txt': b''},
+                          '--no-renames')
+    deleted, added, empty = parse_diff(diff_lines(diff))
+    self.assertTrue(deleted.is_delete)
+    self.assertEqual((deleted.old_path, deleted.new_path), ('a.txt', None))
+    self.assertTrue(added.is_new)
+    self.assertEqual((added.old_path, added.new_path), (None, 'b.txt'))
+    self.assertEqual(added.new_blob, self.blob(TEXT))
+    self.assertTrue(empty.is_new)
+    self.assertEqual((empty.path, empty.hunks), ('c.txt', []))
+
+  def test_rename(self):
+    after = TEXT.replace(b'line 20\n', b'line twenty\n')
+    diff = self.make_diff({'a.txt': TEXT}, {'dir/b.txt': after}, '-M')
+    file_patch, = parse_diff(diff_lines(diff))
+    self.assertTrue(file_patch.is_rename)
+    self.assertEqual((file_patch.old_path, file_patch.new_path),
+                     ('a.txt', 'dir/b.txt'))
+    self.assertEqual(len(file_patch.hunks), 1)
+
+  def test_copy(self):
+    diff = self.make_diff({'a.txt': TEXT}, {'a.txt': TEXT, 'b.txt': TEXT},
+                          '-C', '--find-copies-harder')
+    self.assertIn(b'copy from a.txt', diff)
+    file_patch, = parse_diff(diff_lines(diff))
+    self.assertTrue(file_patch.is_copy)
+    self.assertFalse(file_patch.is_rename)
+    self.assertEqual((file_patch.old_path, file_patch.new_path),
+                     ('a.txt', 'b.txt'))
+
+  def test_quoted_path(self):
+    diff = self.make_diff({'a.txt': TEXT}, {'a.txt': TEXT, 'ü "q".txt': TEXT})
+    file_patch, = parse_diff(diff_lines(diff))
+    self.assertEqual(file_patch.path, 'ü "q".txt')
+
+  def test_mode_change(self):
+    diff = self.make_diff({'a.sh': TEXT}, {'a.sh': ('100755', TEXT)})
+    file_patch, = parse_diff(diff_lines(diff))
+    self.assertEqual((file_patch.old_mode, file_patch.new_mode),
+                     ('100644', '100755'))
+    self.assertEqual(file_patch.hunks, [])
+
+  def test_binary(self):
+    data = bytes(range(256)) * 4
+    diff = self.make_diff({'a.txt': TEXT}, {'a.txt': TEXT, 'blob.bin': data})
+    file_patch, = parse_diff(diff_lines(diff))
+    self.assertEqual(file_patch.binary, ('literal', data))
+    self.assertEqual(file_patch.new_blob, self.blob(data))
+
+  def test_corrupt_hunk_header(self):
+    diff = self.make_diff({'a.txt': TEXT},
+                          {'a.txt': TEXT.replace(b'line 5\n', b'five\n')})
+    lines = diff_lines(diff)
+    lines = [line if not line.startswith('@@') else '@@ bogus @@\n'
+             for line in lines]
+    with self.assertRaises(PatchParseError):
+      parse_diff(lines)
+
+  def test_empty_diff(self):
+    self.assertEqual(parse_diff(['Subject: nothing\n', '\n', '---\n']), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -9,7 +9,8 @@ import shutil
 import subprocess
 import sys
 from urllib.request import urlopen
-import zipfile
+
+from lib.zip_writer import walk_files, walk_tree, write_zip
 
 # from lib.config import is_verbose_mode
 def is_verbose_mode():
@@ -68,22 +69,21 @@ def download(text, url, path):
   return path
 
 
-def make_zip(zip_file_path, files, dirs):
+def make_zip(zip_file_path, files, dirs, deterministic=False,
+             compression=None):
   safe_unlink(zip_file_path)
-  if sys.platform == 'darwin':
+  if sys.platform == 'darwin' and not deterministic and compression is None:
     allfiles = files + dirs
     execute(['zip', '-r', '-y', zip_file_path] + allfiles)
   else:
-    with zipfile.ZipFile(zip_file_path, "w",
-                         zipfile.ZIP_DEFLATED,
-                         allowZip64=True) as zip_file:
-      for filename in files:
-        zip_file.write(filename, filename)
-      for dirname in dirs:
-        for root, _, filenames in os.walk(dirname):
-          for f in filenames:
-            zip_file.write(os.path.join(root, f))
-      zip_file.close()
+    # Like 'zip -r -y', keep the directories and symlinks of bundles on macOS.
+    tree = sys.platform == 'darwin'
+    members = [(filename, filename) for filename in files]
+    for dirname in dirs:
+      paths = walk_tree(dirname) if tree else walk_files(dirname)
+      members += [(path, path) for path in paths]
+    write_zip(zip_file_path, members, deterministic=deterministic,
+              symlinks=tree, compression=compression)
 
 
 def rm_rf(path):
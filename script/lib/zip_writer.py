@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+
+"""Writes zip archives, deflating their members across a thread pool.
+
+Every member is deflated in blocks of BLOCK_SIZE bytes. Each block is
+primed with the 32 KiB of input before it, and the blocks are joined into a
+single deflate stream the way pigz joins them. zlib releases the GIL while it
+compresses, so even the blocks of one large binary are spread over every
+core. The blocks depend only on the input, so the archive holds the same
+bytes whatever the number of workers.
+
+The size, CRC and SHA-256 of every member's input are recorded next to the
+archive. When it is rebuilt, the compressed data of members whose input is
+unchanged is copied from the previous archive instead of compressed again.
+Several archives can be written at once, compressing the inputs they share
+only once.
+
+In deterministic mode every member gets the same timestamp and normalized
+permissions, the members are sorted by name and no extra fields are
+written, so the same inputs always give the same archive.
+
+Files can be added to an existing archive, whatever wrote it, which is then
+rewritten as a deterministic archive without compressing its members again.
+
+A compression policy can store members, or compress them with another
+deflate level, bzip2 or LZMA, by name pattern. Only deflate is split into
+blocks; a member compressed another way is compressed by a single worker.
+"""
+
+import bz2
+from collections import deque
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import hashlib
+import json
+import os
+import stat
+import struct
+import time
+import zipfile
+import zlib
+
+BLOCK_SIZE = 1024 * 1024
+WINDOW_SIZE = 32 * 1024
+
+# Same limits as zipfile.
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX_COUNT = (1 << 16) - 1
+DEFAULT_VERSION = 20
+ZIP64_VERSION = 45
+METHOD_VERSIONS = {
+  zipfile.ZIP_STORED: DEFAULT_VERSION,
+  zipfile.ZIP_DEFLATED: DEFAULT_VERSION,
+  zipfile.ZIP_BZIP2: 46,
+  zipfile.ZIP_LZMA: 63,
+}
+# Set for LZMA members, whose data ends with an end of stream marker.
+LZMA_EOS_FLAG = 0x02
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+
+LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+CENTRAL_HEADER_SIGNATURE = b'PK\001\002'
+END_RECORD_SIGNATURE = b'PK\005\006'
+ZIP64_END_RECORD_SIGNATURE = b'PK\006\006'
+ZIP64_LOCATOR_SIGNATURE = b'PK\006\007'
+
+# The earliest time a zip member can have.
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+UNIX = 3
+
+DIGESTS_VERSION = 2
+COPY_CHUNK_SIZE = 1024 * 1024
+
+METHODS = {
+  'store': zipfile.ZIP_STORED,
+  'deflate': zipfile.ZIP_DEFLATED,
+  'bzip2': zipfile.ZIP_BZIP2,
+  'lzma': zipfile.ZIP_LZMA,
+}
+LEVELS = {
+  zipfile.ZIP_DEFLATED: range(0, 10),
+  zipfile.ZIP_BZIP2: range(1, 10),
+}
+
+
+def parse_compression(text):
+  """Parse a compression policy, comma-separated 'PATTERN=METHOD[:LEVEL]'
+  rules such as '*.pak=store,*.dat=deflate:9', into (pattern, method, level)
+  tuples. METHOD is one of METHODS; without a LEVEL, a deflate member gets
+  the level the archive is written with. Raises ValueError if |text| is not
+  a valid policy."""
+  rules = []
+  for rule in filter(None, text.split(',')):
+    pattern, sep, method = rule.partition('=')
+    name, _, level = method.partition(':')
+    if not sep or not pattern or name not in METHODS:
+      raise ValueError(f'invalid compression rule: {rule}')
+    method = METHODS[name]
+    if not level:
+      level = None
+    elif level.isdigit() and int(level) in LEVELS.get(method, ()):
+      level = int(level)
+    else:
+      raise ValueError(f'invalid level for {name}: {level}')
+    rules.append((pattern, method, level))
+  return rules
+
+
+def compression_for(compression, arcname, level):
+  """The (method, level) of the first rule in |compression| that matches
+  |arcname|, or deflate at |level|."""
+  for pattern, method, rule_level in compression or []:
+    if fnmatch.fnmatchcase(arcname, pattern):
+      if method == zipfile.ZIP_DEFLATED and rule_level is None:
+        return method, level
+      return method, rule_level
+  return zipfile.ZIP_DEFLATED, level
+
+
+def digest_file(path):
+  """Return the CRC-32 and SHA-256 of |path|, read once."""
+  crc = 0
+  sha256 = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(BLOCK_SIZE), b''):
+      crc = zlib.crc32(chunk, crc)
+      sha256.update(chunk)
+  return crc, sha256.hexdigest()
+
+
+def deflate_block(path, offset, size, last, level):
+  """Deflate |size| bytes of |path| from |offset|, as the part of the file's
+  deflate stream that starts at a byte boundary there."""
+  start = max(offset - WINDOW_SIZE, 0)
+  with open(path, 'rb') as f:
+    f.seek(start)
+    data = memoryview(f.read(offset + size - start))
+  if offset > start:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                  zdict=data[:offset - start])
+  else:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(data[offset - start:]) + compressor.flush(
+    zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def read_block(path, offset, size):
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    return f.read(size)
+
+
+def compress_file(path, method, level):
+  """Compress all of |path| with bzip2 or LZMA, as zipfile does."""
+  if method == zipfile.ZIP_BZIP2:
+    compressor = bz2.BZ2Compressor(level or 9)
+  else:
+    compressor = zipfile.LZMACompressor()
+  chunks = []
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(BLOCK_SIZE), b''):
+      chunks.append(compressor.compress(chunk))
+  chunks.append(compressor.flush())
+  return b''.join(chunks)
+
+
+def block_offsets(size):
+  """Yield (offset, size, last) for the blocks of a file of |size| bytes. An
+  empty file still needs one block to end its deflate stream."""
+  for offset in range(0, max(size, 1), BLOCK_SIZE):
+    yield offset, min(BLOCK_SIZE, size - offset), offset + BLOCK_SIZE >= size
+
+
+def member_tasks(path, size, method, level):
+  """The tasks that give the compressed data of |path|, in order."""
+  if method == zipfile.ZIP_DEFLATED:
+    return [(deflate_block, path, *block, level)
+            for block in block_offsets(size)]
+  if method == zipfile.ZIP_STORED:
+    return [(read_block, path, offset, block_size)
+            for offset, block_size, _ in block_offsets(size)]
+  return [(compress_file, path, method, level)]
+
+
+def ordered_results(executor, tasks, window):
+  """Yield the results of |tasks|, (function, *args) tuples, in order. At
+  most |window| of them are queued, running or waiting to be consumed at any
+  time, so compressed blocks don't pile up ahead of the writer."""
+  pending = deque()
+  for task in tasks:
+    pending.append(executor.submit(*task))
+    if len(pending) >= window:
+      yield pending.popleft().result()
+  while pending:
+    yield pending.popleft().result()
+
+
+def encode_filename(zinfo):
+  flag_bits = zinfo.flag_bits
+  if zinfo.compress_type == zipfile.ZIP_LZMA:
+    flag_bits |= LZMA_EOS_FLAG
+  try:
+    return zinfo.filename.encode('ascii'), flag_bits
+  except UnicodeEncodeError:
+    return zinfo.filename.encode('utf-8'), flag_bits | 0x800
+
+
+def dos_date_time(date_time):
+  year, month, day, hour, minute, second = date_time
+  return ((year - 1980) << 9 | month << 5 | day,
+          hour << 11 | minute << 5 | second // 2)
+
+
+def zip64_extra(*values):
+  return struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values)
+
+
+def local_header(zinfo, zip64):
+  filename, flag_bits = encode_filename(zinfo)
+  dosdate, dostime = dos_date_time(zinfo.date_time)
+  extra = zinfo.extra
+  compress_size, file_size = zinfo.compress_size, zinfo.file_size
+  version = METHOD_VERSIONS[zinfo.compress_type]
+  if zip64:
+    extra = zip64_extra(file_size, compress_size) + extra
+    compress_size = file_size = 0xffffffff
+    version = max(version, ZIP64_VERSION)
+  return LOCAL_HEADER.pack(
+    LOCAL_HEADER_SIGNATURE, version, 0, flag_bits, zinfo.compress_type,
+    dostime, dosdate, zinfo.CRC, compress_size, file_size, len(filename),
+    len(extra)) + filename + extra
+
+
+def central_header(zinfo):
+  filename, flag_bits = encode_filename(zinfo)
+  dosdate, dostime = dos_date_time(zinfo.date_time)
+  compress_size, file_size = zinfo.compress_size, zinfo.file_size
+  header_offset = zinfo.header_offset
+  extra_values = []
+  if file_size > ZIP64_LIMIT:
+    extra_values.append(file_size)
+    file_size = 0xffffffff
+  if compress_size > ZIP64_LIMIT:
+    extra_values.append(compress_size)
+    compress_size = 0xffffffff
+  if header_offset > ZIP64_LIMIT:
+    extra_values.append(header_offset)
+    header_offset = 0xffffffff
+  extra = zinfo.extra
+  version = METHOD_VERSIONS[zinfo.compress_type]
+  if extra_values:
+    extra = zip64_extra(*extra_values) + extra
+    version = max(version, ZIP64_VERSION)
+  return CENTRAL_HEADER.pack(
+    CENTRAL_HEADER_SIGNATURE, version, zinfo.create_system, version, 0,
+    flag_bits, zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+    compress_size, file_size, len(filename), len(extra), len(zinfo.comment),
+    0, zinfo.internal_attr, zinfo.external_attr, header_offset
+  ) + filename + extra + zinfo.comment
+
+
+def digest_file_path(zip_path):
+  return zip_path + '.digests'
+
+
+def read_digests(zip_path):
+  """Load the inputs recorded for the members of |zip_path|, keyed by
+  member name. Digests written with a different block size are useless,
+  since the members would not be compressed to the same bytes."""
+  try:
+    with open(digest_file_path(zip_path), encoding='utf-8') as f:
+      data = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  if not isinstance(data, dict) or data.get('version') != DIGESTS_VERSION \
+     or data.get('block_size') != BLOCK_SIZE:
+    return {}
+  return data.get('members', {})
+
+
+def write_digests(zip_path, digests):
+  with open(digest_file_path(zip_path), 'w', encoding='utf-8') as f:
+    json.dump({
+      'version': DIGESTS_VERSION,
+      'block_size': BLOCK_SIZE,
+      'members': digests,
+    }, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+class PreviousArchive:
+  """The archive at |path| that is about to be replaced, and the inputs
+  recorded for its members. Raises OSError or zipfile.BadZipFile if there
+  is no usable archive."""
+
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    try:
+      self.members = {
+        zinfo.filename: zinfo
+        for zinfo in zipfile.ZipFile(self.file).infolist()
+      }
+    except Exception:
+      self.file.close()
+      raise
+    self.digests = read_digests(path)
+
+  def candidate(self, zinfo, level):
+    """The previous member that |zinfo| may be able to reuse: one with the
+    same name and size, compressed with the same method and level."""
+    previous = self.members.get(zinfo.filename)
+    recorded = self.digests.get(zinfo.filename)
+    if previous is None or recorded is None:
+      return None
+    if (previous.file_size, previous.CRC, previous.compress_type) != (
+        recorded['size'], recorded['crc'], recorded['method']) \
+       or (recorded['method'], recorded['level']) != (zinfo.compress_type,
+                                                      level) \
+       or recorded['size'] != zinfo.file_size:
+      return None
+    return previous
+
+  def unchanged(self, previous, crc, sha256):
+    """Whether the input that has |crc| and |sha256| is the one |previous|
+    was compressed from."""
+    recorded = self.digests[previous.filename]
+    return previous.CRC == crc and recorded['sha256'] == sha256
+
+  def read_member(self, previous):
+    """Yield the compressed data of |previous| as it is stored."""
+    self.file.seek(previous.header_offset)
+    header = LOCAL_HEADER.unpack(self.file.read(LOCAL_HEADER.size))
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+      raise zipfile.BadZipFile(f'bad local header for {previous.filename}')
+    self.file.seek(header[-2] + header[-1], os.SEEK_CUR)
+    yield from copy_chunks(self.file, previous.compress_size)
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+def copy_chunks(f, size):
+  """Yield the next |size| bytes of |f|."""
+  while size:
+    chunk = f.read(min(COPY_CHUNK_SIZE, size))
+    if not chunk:
+      raise zipfile.BadZipFile(f'{f.name} is truncated')
+    size -= len(chunk)
+    yield chunk
+
+
+def read_range(path, offset, size):
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    yield from copy_chunks(f, size)
+
+
+def open_previous(path):
+  if path is None:
+    return None
+  try:
+    return PreviousArchive(path)
+  except (OSError, zipfile.BadZipFile):
+    return None
+
+
+class ZipWriter:
+  """A zip archive being written to |path|, one member after the other.
+  Call close() to write the central directory."""
+
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.members = []
+
+  def add_member(self, zinfo, chunks):
+    """Write the member described by |zinfo|, whose CRC is already known,
+    with |chunks| as its compressed data, and return the offset of that
+    data. The local header is written again once the compressed size is
+    known, like zipfile does."""
+    zinfo.header_offset = self.file.tell()
+    zinfo.compress_size = 0
+    zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+    self.file.write(local_header(zinfo, zip64))
+    data_offset = self.file.tell()
+    for chunk in chunks:
+      self.file.write(chunk)
+      zinfo.compress_size += len(chunk)
+    if not zip64 and zinfo.compress_size > ZIP64_LIMIT:
+      raise zipfile.LargeZipFile(
+        f'{zinfo.filename} compressed to more than the zip64 limit')
+    end = self.file.tell()
+    self.file.seek(zinfo.header_offset)
+    self.file.write(local_header(zinfo, zip64))
+    self.file.seek(end)
+    self.members.append(zinfo)
+    return data_offset
+
+  def close(self):
+    start = self.file.tell()
+    for zinfo in self.members:
+      self.file.write(central_header(zinfo))
+    end = self.file.tell()
+    count, size, offset = len(self.members), end - start, start
+    if count > ZIP_MAX_COUNT or size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+      self.file.write(ZIP64_END_RECORD.pack(
+        ZIP64_END_RECORD_SIGNATURE, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+        count, count, size, offset))
+      self.file.write(ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, end, 1))
+      count = min(count, ZIP_MAX_COUNT)
+      size = min(size, 0xffffffff)
+      offset = min(offset, 0xffffffff)
+    self.file.write(END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0, count, count,
+                                    size, offset, 0))
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    if exc_info[0] is None:
+      self.close()
+    else:
+      self.file.close()
+
+
+def walk_files(directory):
+  """The regular files under |directory|, as os.walk() finds them."""
+  files = []
+  for root, _, filenames in os.walk(directory):
+    for filename in filenames:
+      files.append(os.path.join(root, filename))
+  return files
+
+
+def walk_tree(path):
+  """|path| and, if it is a directory, every directory, file and symlink
+  under it, like 'zip -r -y' would store them. Symlinks to directories are
+  not followed."""
+  paths = [path]
+  if os.path.isdir(path) and not os.path.islink(path):
+    for root, dirnames, filenames in os.walk(path):
+      paths += [os.path.join(root, name) for name in dirnames + filenames]
+  return paths
+
+
+def normalized_mode(mode):
+  if stat.S_ISLNK(mode):
+    return stat.S_IFLNK | 0o777
+  if stat.S_ISDIR(mode):
+    return stat.S_IFDIR | 0o755
+  return stat.S_IFREG | (0o755 if mode & 0o111 else 0o644)
+
+
+def member_info(path, arcname, deterministic=False, symlinks=False):
+  """Return the ZipInfo for storing |path| as |arcname|, and the data of
+  members that are stored as they are: directories, and symlinks when
+  |symlinks| is set. The data of regular files is None."""
+  data = None
+  if symlinks and os.path.islink(path):
+    st = os.lstat(path)
+    zinfo = zipfile.ZipInfo(
+      os.path.normpath(os.path.splitdrive(arcname)[1]).lstrip(os.sep),
+      FIXED_DATE_TIME if deterministic else time.localtime(st.st_mtime)[:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    data = os.readlink(path).encode('utf-8')
+    zinfo.file_size = len(data)
+  else:
+    # The real time is thrown away in deterministic mode, so don't let one
+    # before 1980 (which a zip can't hold) fail the build.
+    zinfo = zipfile.ZipInfo.from_file(path, arcname,
+                                      strict_timestamps=not deterministic)
+    if zinfo.is_dir():
+      data = b''
+  zinfo.compress_type = (zipfile.ZIP_STORED if data is not None
+                         else zipfile.ZIP_DEFLATED)
+  if deterministic:
+    make_deterministic(zinfo)
+  return zinfo, data
+
+
+def make_deterministic(zinfo):
+  """Give |zinfo| the fixed timestamp, normalized permissions and no extra
+  fields of a deterministic archive."""
+  zinfo.date_time = FIXED_DATE_TIME
+  zinfo.create_system = UNIX
+  zinfo.external_attr = (
+    normalized_mode(zinfo.external_attr >> 16) << 16
+    | (zinfo.external_attr & 0x10))
+  zinfo.extra = b''
+
+
+def write_zip(zip_path, members, jobs=None,
+              level=zlib.Z_DEFAULT_COMPRESSION, previous_zip=None,
+              deterministic=False, symlinks=False, compression=None):
+  """Write |members|, a list of (path, arcname) pairs, to |zip_path| in
+  order, deflating them on |jobs| threads (one per core by default).
+  Directories are stored as directory entries and, with |symlinks|,
+  symlinks as links rather than the files they point to. |compression| is
+  a policy from parse_compression() for the members that should not be
+  deflated at |level|.
+
+  Members whose input has the same size, CRC and SHA-256 as in
+  |previous_zip|, which may be |zip_path| itself, are copied from it as they
+  are. Returns how many members were copied."""
+  return write_zips([(zip_path, members, previous_zip)], jobs, level,
+                    deterministic, symlinks, compression)[0]
+
+
+def write_zips(outputs, jobs=None, level=zlib.Z_DEFAULT_COMPRESSION,
+               deterministic=False, symlinks=False, compression=None):
+  """Write every archive in |outputs|, a list of (zip_path, members,
+  previous_zip) tuples, like write_zip() does. Every input is hashed and
+  compressed at most once however many archives hold it; the archives after
+  the first copy its compressed data from the one it was written to.
+  Returns how many members of each archive were copied from a previous
+  archive."""
+  jobs = jobs or os.cpu_count() or 1
+  archives = []
+  inputs = {}
+  try:
+    for zip_path, members, previous_zip in outputs:
+      previous = open_previous(previous_zip)
+      entries = []
+      archives.append((zip_path, previous, entries))
+      for path, arcname in members:
+        zinfo, data = member_info(path, arcname, deterministic, symlinks)
+        if data is not None:
+          entries.append((zinfo, None, data))
+          continue
+        zinfo.compress_type, member_level = compression_for(
+          compression, zinfo.filename, level)
+        # An input is only shared by members that compress it the same way.
+        key = (os.path.realpath(path), zinfo.compress_type, member_level)
+        if key not in inputs:
+          inputs[key] = {
+            'path': path,
+            'level': member_level,
+            'candidates': [],
+            'digest': None,
+            'copy': None,
+            'scheduled': False,
+            'compressed': None,
+          }
+        if previous is not None:
+          candidate = previous.candidate(zinfo, member_level)
+          if candidate is not None:
+            inputs[key]['candidates'].append((previous, candidate))
+        entries.append((zinfo, inputs[key], None))
+      if deterministic:
+        entries.sort(key=lambda entry: entry[0].filename)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+      # Only the inputs that may be unchanged are hashed up front; the
+      # others are hashed along with their compression.
+      to_hash = [source for source in inputs.values() if source['candidates']]
+      for source, digest in zip(to_hash, executor.map(
+          digest_file, [source['path'] for source in to_hash])):
+        source['digest'] = digest
+        for previous, candidate in source['candidates']:
+          if previous.unchanged(candidate, *digest):
+            source['copy'] = (previous, candidate)
+            break
+
+      tasks = []
+      plans = []
+      for zip_path, previous, entries in archives:
+        plan = []
+        for zinfo, source, data in entries:
+          block_count = None
+          if source is not None and source['copy'] is None \
+             and not source['scheduled']:
+            source['scheduled'] = True
+            if source['digest'] is None:
+              tasks.append((digest_file, source['path']))
+            blocks = member_tasks(source['path'], zinfo.file_size,
+                                  zinfo.compress_type, source['level'])
+            tasks += blocks
+            block_count = len(blocks)
+          plan.append((zinfo, source, data, block_count))
+        plans.append(plan)
+
+      results = ordered_results(executor, tasks, jobs * 4)
+      reused = []
+      for (zip_path, _, _), plan in zip(archives, plans):
+        copied = 0
+        with ZipWriter(zip_path + '.tmp') as writer:
+          for zinfo, source, data, block_count in plan:
+            if source is None:
+              zinfo.CRC = zlib.crc32(data)
+              writer.add_member(zinfo, [data])
+            elif source['copy'] is not None:
+              previous, candidate = source['copy']
+              zinfo.CRC = candidate.CRC
+              writer.add_member(zinfo, previous.read_member(candidate))
+              copied += 1
+            elif block_count is None:
+              # Already compressed into an earlier archive, or earlier in
+              # this one.
+              writer.file.flush()
+              zinfo.CRC = source['digest'][0]
+              writer.add_member(zinfo, read_range(*source['compressed']))
+            else:
+              source['digest'] = source['digest'] or next(results)
+              zinfo.CRC = source['digest'][0]
+              data_offset = writer.add_member(
+                zinfo, (next(results) for _ in range(block_count)))
+              source['compressed'] = (zip_path + '.tmp', data_offset,
+                                      zinfo.compress_size)
+        reused.append(copied)
+  except BaseException:
+    for zip_path, _, _ in archives:
+      if os.path.exists(zip_path + '.tmp'):
+        os.remove(zip_path + '.tmp')
+    raise
+  finally:
+    for _, previous, _ in archives:
+      if previous is not None:
+        previous.close()
+
+  for zip_path, _, entries in archives:
+    os.replace(zip_path + '.tmp', zip_path)
+    write_digests(zip_path, {
+      zinfo.filename: {
+        'size': zinfo.file_size,
+        'crc': source['digest'][0],
+        'sha256': source['digest'][1],
+        'method': zinfo.compress_type,
+        'level': source['level'],
+      }
+      for zinfo, source, _ in entries
+      if source is not None
+    })
+  return reused
+
+
+def add_to_zip(zip_path, members, jobs=None,
+               level=zlib.Z_DEFAULT_COMPRESSION):
+  """Add |members|, a list of (path, arcname) pairs, to the archive at
+  |zip_path|, replacing the members of the same name like 'zip' does. The
+  members already there are copied as they are stored, whatever wrote them,
+  and the result is deterministic like write_zip(deterministic=True)
+  writes it."""
+  added_path = zip_path + '.added'
+  try:
+    write_zip(added_path, members, jobs, level, deterministic=True)
+    with PreviousArchive(zip_path) as existing, \
+         PreviousArchive(added_path) as added:
+      entries = {name: (existing, zinfo)
+                 for name, zinfo in existing.members.items()}
+      entries.update({name: (added, zinfo)
+                      for name, zinfo in added.members.items()})
+      with ZipWriter(zip_path + '.tmp') as writer:
+        for name in sorted(entries):
+          archive, previous = entries[name]
+          zinfo = copy.copy(previous)
+          make_deterministic(zinfo)
+          # The sizes go in the local header, not in a data descriptor.
+          zinfo.flag_bits &= ~0x08
+          writer.add_member(zinfo, archive.read_member(previous))
+      digests = {name: digest for name, digest in existing.digests.items()
+                 if name not in added.members}
+      digests.update(added.digests)
+    os.replace(zip_path + '.tmp', zip_path)
+    write_digests(zip_path, digests)
+  finally:
+    for path in (zip_path + '.tmp', added_path, digest_file_path(added_path)):
+      if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+
+from lib.patch_index import PatchIndex, default_index_path, find_patches, \
+                            format_hunk
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(
+    description="Find which patches touch which files and lines"
+  )
+  parser.add_argument(
+    "--patches-config",
+    type=argparse.FileType("r"),
+    required=True,
+    help="patches' config in the JSON format",
+  )
+  parser.add_argument(
+    "--index-file",
+    help="where to keep the index. Defaults to a file next to the config.",
+  )
+  subparsers = parser.add_subparsers(dest="operation", required=True)
+
+  subparsers.add_parser(
+    "update", help="bring the index up to date with the patch files"
+  )
+
+  query_subparser = subparsers.add_parser(
+    "query", help="list the patches that touch a file"
+  )
+  query_subparser.add_argument(
+    "path",
+    help="path or glob of the patched file, relative to its repo or to the "
+         "directory the config's paths are relative to",
+  )
+  query_subparser.add_argument(
+    "--line",
+    type=int,
+    help="only list patches with a hunk covering this line of the file as it "
+         "is before the patch applies",
+  )
+  query_subparser.add_argument(
+    "--json", action="store_true", help="print the matches as JSON"
+  )
+  return parser.parse_args(argv)
+
+
+def print_matches(matches):
+  for target, patch_filename, position, patched_file, hunks in matches:
+    print(
+      f"{os.path.join(target.get('patch_dir'), patch_filename)} "
+      f"(patch {position} in {target.get('repo')})"
+    )
+    path = patched_file['path'] or patched_file['old_path']
+    if patched_file['old_path'] not in (None, path):
+      path = f"{patched_file['old_path']} => {path}"
+    if patched_file['binary']:
+      print(f"  {path}: binary")
+    elif not hunks:
+      print(f"  {path}: no content change")
+    else:
+      print(f"  {path}: {' '.join(format_hunk(hunk) for hunk in hunks)}")
+
+
+def main(argv):
+  args = parse_args(argv)
+  patches_config = json.load(args.patches_config)
+  index = PatchIndex(
+    args.index_file
+    or default_index_path(os.path.dirname(args.patches_config.name))
+  )
+
+  if args.operation == "update":
+    for target in patches_config:
+      index.series(target.get('patch_dir'))
+    print(f"Indexed {len(index.entries)} patches, {index.parsed} re-read")
+  elif args.operation == "query":
+    matches = list(
+      find_patches(index, patches_config, args.path, line=args.line)
+    )
+    if args.json:
+      json.dump(
+        [
+          {
+            'patch_dir': target.get('patch_dir'),
+            'repo': target.get('repo'),
+            'patch': patch_filename,
+            'position': position,
+            'path': patched_file['path'],
+            'old_path': patched_file['old_path'],
+            'binary': patched_file['binary'],
+            'hunks': hunks,
+          }
+          for target, patch_filename, position, patched_file, hunks in matches
+        ],
+        sys.stdout,
+        indent=2,
+      )
+      sys.stdout.write("\n")
+    else:
+      print_matches(matches)
+
+  index.save()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -1,73 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
-import hashlib
 import json
 import os
-import posixpath
 import sys
 import traceback
 
-from lib.patches import patch_from_dir
+from lib.mtime_cache import apply_mtimes, digest_file_path, \
+                            find_cache_file, generate_cache, legacy_path, \
+                            load_digests, read_cache, restore_times, \
+                            save_digests, snapshot_times, write_cache
+from lib.patch_index import PatchIndex, default_index_path, \
+                            patched_file_paths
 
 
-def patched_file_paths(patches_config):
-    for target in patches_config:
-        patch_dir = target.get('patch_dir')
-        repo = target.get('repo')
-        for line in patch_from_dir(patch_dir).split("\n"):
-            if line.startswith("+++"):
-                yield posixpath.join(repo, line[6:])
-
-
-def generate_cache(patches_config):
-    mtime_cache = {}
-
-    for file_path in patched_file_paths(patches_config):
-        if file_path in mtime_cache:
-            # File may be patched multiple times, we don't need to
-            # rehash it since we are looking at the final result
-            continue
-
-        if not os.path.exists(file_path):
-            print("Skipping non-existent file:", file_path)
-            continue
-
-        with open(file_path, "rb") as f:
-            mtime_cache[file_path] = {
-                "sha256": hashlib.sha256(f.read()).hexdigest(),
-                "atime": os.path.getatime(file_path),
-                "mtime": os.path.getmtime(file_path),
-            }
-
-    return mtime_cache
-
-
-def apply_mtimes(mtime_cache):
-    updates = []
-
-    for file_path, metadata in mtime_cache.items():
-        if not os.path.exists(file_path):
-            print("Skipping non-existent file:", file_path)
-            continue
-
-        with open(file_path, "rb") as f:
-            if hashlib.sha256(f.read()).hexdigest() == metadata["sha256"]:
-                updates.append(
-                    [file_path, metadata["atime"], metadata["mtime"]]
-                )
-
-    # We can't atomically set the times for all files at once, but by waiting
-    # to update until we've checked all the files we at least have less chance
-    # of only updating some files due to an error on one of the files
-    for [file_path, atime, mtime] in updates:
-        os.utime(file_path, (atime, mtime))
+def load_patch_index(args):
+    return PatchIndex(
+        args.index_file
+        or default_index_path(os.path.dirname(args.patches_config.name))
+    )
 
 
-def set_mtimes(patches_config, mtime):
+def set_mtimes(patches_config, index, mtime):
     mtime_cache = {}
 
-    for file_path in patched_file_paths(patches_config):
+    for file_path in patched_file_paths(index, patches_config):
         if file_path in mtime_cache:
             continue
 
@@ -118,6 +75,44 @@ def main():
         help="mtime to use for all patched files",
     )
 
+    snapshot_subparser = subparsers.add_parser(
+        "snapshot",
+        help="record the mtimes of every file in the patched repos before a "
+        "sync",
+    )
+    restore_subparser = subparsers.add_parser(
+        "restore",
+        help="restore the mtimes of every file in the patched repos whose "
+        "content the sync left unchanged",
+    )
+    restore_subparser.add_argument(
+        "--preserve-snapshot",
+        action="store_true",
+        help="don't delete the snapshot after restoring",
+    )
+    clear_subparser = subparsers.add_parser(
+        "clear",
+        help="delete a cache or snapshot left by an earlier aborted sync, so "
+        "that it isn't applied once the hook that writes it is turned off",
+    )
+    clear_subparser.add_argument(
+        "--cache-file", help="mtime cache file"
+    )
+    clear_subparser.add_argument(
+        "--snapshot-file", help="mtime snapshot file"
+    )
+
+    for subparser in [snapshot_subparser, restore_subparser]:
+        subparser.add_argument(
+            "--snapshot-file", required=True, help="mtime snapshot file"
+        )
+        subparser.add_argument(
+            "--patches-config",
+            type=argparse.FileType("r"),
+            required=True,
+            help="patches' config in the JSON format",
+        )
+
     for subparser in [generate_subparser, set_subparser]:
         subparser.add_argument(
             "--patches-config",
@@ -125,23 +120,38 @@ def main():
             required=True,
             help="patches' config in the JSON format",
         )
+        subparser.add_argument(
+            "--index-file",
+            help="patch index to use and update. Defaults to a file next to "
+            "the patches' config.",
+        )
 
     args = parser.parse_args()
 
     if args.operation == "generate":
-        try:
-            # Cache file may exist from a previously aborted sync. Reuse it.
-            with open(args.cache_file, mode='r', encoding='utf-8') as fin:
-                json.load(fin)  # Make sure it's not an empty file
+        # Cache file may exist from a previously aborted sync. Reuse it,
+        # converting it if it was written by an earlier version.
+        existing = find_cache_file(args.cache_file)
+        if existing is not None:
+            try:
+                mtime_cache = read_cache(existing)
+                if existing != args.cache_file:
+                    write_cache(args.cache_file, mtime_cache)
+                    os.remove(existing)
                 print("Using existing mtime cache for patches")
                 return 0
-        except Exception:
-            pass
+            except Exception:
+                pass
 
         try:
-            with open(args.cache_file, mode="w", encoding='utf-8') as fin:
-                mtime_cache = generate_cache(json.load(args.patches_config))
-                json.dump(mtime_cache, fin, indent=2)
+            index = load_patch_index(args)
+            mtime_cache = generate_cache(
+                json.load(args.patches_config),
+                index,
+                load_digests(digest_file_path(args.cache_file)),
+            )
+            write_cache(args.cache_file, mtime_cache)
+            index.save()
         except Exception:
             print(
                 "ERROR: failed to generate mtime cache for patches",
@@ -150,16 +160,17 @@ def main():
             traceback.print_exc(file=sys.stderr)
             return 0
     elif args.operation == "apply":
-        if not os.path.exists(args.cache_file):
+        cache_file = find_cache_file(args.cache_file)
+        if cache_file is None:
             print("ERROR: --cache-file does not exist", file=sys.stderr)
             return 0  # Cache file may not exist, fail more gracefully
 
         try:
-            with open(args.cache_file, mode='r', encoding='utf-8') as file_in:
-                apply_mtimes(json.load(file_in))
+            digests = apply_mtimes(read_cache(cache_file))
+            save_digests(digest_file_path(args.cache_file), digests)
 
             if not args.preserve_cache:
-                os.remove(args.cache_file)
+                os.remove(cache_file)
         except Exception:
             print(
                 "ERROR: failed to apply mtime cache for patches",
@@ -167,6 +178,50 @@ def main():
             )
             traceback.print_exc(file=sys.stderr)
             return 0
+    elif args.operation == "snapshot":
+        # Snapshot may exist from a previously aborted sync. Reuse it, since
+        # it describes the files from before that sync.
+        try:
+            read_cache(args.snapshot_file)
+            print("Using existing mtime snapshot")
+            return 0
+        except Exception:
+            pass
+
+        try:
+            snapshot = snapshot_times(json.load(args.patches_config))
+            write_cache(args.snapshot_file, snapshot)
+        except Exception:
+            print("ERROR: failed to snapshot mtimes", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return 0
+    elif args.operation == "restore":
+        if not os.path.exists(args.snapshot_file):
+            print("ERROR: --snapshot-file does not exist", file=sys.stderr)
+            return 0
+
+        try:
+            restored = restore_times(
+                json.load(args.patches_config),
+                read_cache(args.snapshot_file),
+                args.preserve_snapshot,
+            )
+            print(f"Restored the mtime of {restored} unchanged files")
+
+            if not args.preserve_snapshot:
+                os.remove(args.snapshot_file)
+        except Exception:
+            print("ERROR: failed to restore mtimes", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return 0
+    elif args.operation == "clear":
+        for path in [args.cache_file, args.snapshot_file]:
+            if path is None:
+                continue
+            for stale in [path, legacy_path(path)]:
+                if os.path.exists(stale):
+                    print("Deleting stale", stale)
+                    os.remove(stale)
     elif args.operation == "set":
         answer = input(
             "WARNING: Manually setting mtimes could mess up your build. "
@@ -177,7 +232,9 @@ def main():
             print("Aborting")
             return 0
 
-        set_mtimes(json.load(args.patches_config), args.mtime)
+        index = load_patch_index(args)
+        set_mtimes(json.load(args.patches_config), index, args.mtime)
+        index.save()
 
     return 0
 
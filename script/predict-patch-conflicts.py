@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""Predict how each patch will apply to an upstream commit without applying
+anything.
+
+Exported patches carry the full blob id of every file they modify, so a
+patch applies verbatim exactly when those blobs are what the upstream tree
+holds at those paths. All of the lookups for a repo are sent down a single
+'git cat-file --batch-check' pipe.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from lib import git
+from lib.patch_index import PatchIndex, default_index_path
+
+# From best to worst.
+VERBATIM = 'verbatim'
+THREEWAY = '3-way'
+FUZZ = 'fuzz'
+MOVED = 'moved'
+MISSING = 'missing'
+EXISTS = 'exists'
+STATUSES = [VERBATIM, THREEWAY, FUZZ, MOVED, MISSING, EXISTS]
+
+STATUS_HELP = {
+  VERBATIM: 'apply verbatim',
+  THREEWAY: 'modify files that changed upstream; the original blobs are '
+            'available, so -3 can merge them',
+  FUZZ: 'modify files that changed upstream; the original blobs are not '
+        'available, so they only apply if the context still matches',
+  MOVED: 'modify files that moved upstream',
+  MISSING: 'modify files that no longer exist upstream',
+  EXISTS: 'add files that already exist upstream',
+}
+
+# Stands for content that can't be predicted, e.g. after a patch that didn't
+# apply verbatim.
+UNKNOWN = ''
+
+
+def is_blob(blob):
+  return blob is not None and blob.strip('0') != ''
+
+
+def blob_matches(current, blob):
+  # Older patches may abbreviate the blob ids.
+  return bool(current) and current.startswith(blob)
+
+
+def predict_series(repo, commit, series):
+  """Return a list of (patch_filename, status, files) for |series|, the
+  (patch_filename, files) pairs from the patch index, as it would apply to
+  |commit| in |repo|. |files| holds (path, status, detail) for every file
+  that doesn't apply verbatim."""
+  paths = sorted({
+    path
+    for _, files in series
+    for patched_file in files
+    for path in (patched_file['path'], patched_file['old_path'])
+    if path is not None
+  })
+  blobs = sorted({
+    patched_file['old_blob']
+    for _, files in series
+    for patched_file in files
+    if is_blob(patched_file['old_blob'])
+  })
+  results = git.get_session(repo).info_many(
+    [f'{commit}:{path}' for path in paths] + blobs
+  )
+  upstream = {
+    path: result[0] if result is not None and result[1] == 'blob' else None
+    for path, result in zip(paths, results)
+  }
+  known_blobs = {
+    blob for blob, result in zip(blobs, results[len(paths):])
+    if result is not None
+  }
+
+  moved_to = None
+  def find_moved(blob):
+    nonlocal moved_to
+    if moved_to is None:
+      moved_to = {}
+      for _, object_type, object_id, path in git.ls_tree(repo, commit):
+        if object_type == 'blob':
+          moved_to.setdefault(object_id, []).append(path)
+    return [
+      path for object_id, found in moved_to.items()
+      if object_id.startswith(blob) for path in found
+    ]
+
+  state = dict(upstream)
+  predictions = []
+  for patch_filename, files in series:
+    conflicts = []
+    for patched_file in files:
+      path, old_path = patched_file['path'], patched_file['old_path']
+      old_blob, new_blob = patched_file['old_blob'], patched_file['new_blob']
+      status, detail = VERBATIM, None
+      if old_path is None:
+        if state.get(path) is not None:
+          status = EXISTS
+      else:
+        current = state.get(old_path)
+        if current is None:
+          found = find_moved(old_blob) if is_blob(old_blob) else []
+          status = MOVED if found else MISSING
+          detail = found or None
+        elif is_blob(old_blob) and not blob_matches(current, old_blob):
+          status = THREEWAY if old_blob in known_blobs else FUZZ
+      if status != VERBATIM:
+        conflicts.append((path or old_path, status, detail))
+      if old_path is not None and status not in (MOVED, MISSING):
+        if patched_file['copy']:
+          carried = state.get(old_path)
+        else:
+          carried = state.pop(old_path)
+        if path is not None:
+          if status != VERBATIM:
+            state[path] = UNKNOWN
+          elif is_blob(new_blob):
+            state[path] = new_blob
+          else:
+            # Renames and mode changes without an 'index' line.
+            state[path] = carried
+      elif path is not None and old_path is None:
+        state[path] = new_blob if status == VERBATIM else UNKNOWN
+    worst = max((STATUSES.index(s) for _, s, _ in conflicts), default=0)
+    predictions.append((patch_filename, STATUSES[worst], conflicts))
+  return predictions
+
+
+def predict_config(patches_config, index, ref):
+  """Yield (target, commit, predictions) for every target whose repo has
+  |ref|."""
+  for target in patches_config:
+    repo = target.get('repo')
+    if not os.path.exists(repo):
+      sys.stderr.write(f'Skipping {repo} because it does not exist.\n')
+      continue
+    commit = git.try_get_commit_for_ref(repo, ref)
+    if commit is None:
+      sys.stderr.write(f'Skipping {repo} because it has no {ref}.\n')
+      continue
+    series = index.series(target.get('patch_dir'))
+    yield target, commit, predict_series(repo, commit, series)
+
+
+def print_predictions(target, commit, predictions):
+  counts = {status: 0 for status in STATUSES}
+  for _, status, _ in predictions:
+    counts[status] += 1
+  summary = ', '.join(
+    f'{count} {status}' for status, count in counts.items() if count
+  )
+  print(f"{target.get('patch_dir')} onto {target.get('repo')} at "
+        f"{commit[:12]}: {summary or 'no patches'}")
+  for status in STATUSES[1:]:
+    patches = [p for p in predictions if p[1] == status]
+    if not patches:
+      continue
+    print(f'  {len(patches)} patches {STATUS_HELP[status]}:')
+    for patch_filename, _, conflicts in patches:
+      print(f'    {patch_filename}')
+      for path, file_status, detail in conflicts:
+        if detail:
+          path = f"{path} -> {', '.join(detail)}"
+        print(f'      {file_status:>8}  {path}')
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument(
+    "--patches-config",
+    type=argparse.FileType("r"),
+    required=True,
+    help="patches' config in the JSON format",
+  )
+  parser.add_argument(
+    "--index-file",
+    help="patch index to use and update. Defaults to a file next to the "
+         "patches' config.",
+  )
+  parser.add_argument(
+    "--ref",
+    default=git.UPSTREAM_HEAD,
+    help="upstream commit to check the patches against in each repo",
+  )
+  parser.add_argument(
+    "--repo",
+    action="append",
+    help="only check this repo. May be given more than once.",
+  )
+  parser.add_argument(
+    "--json",
+    action="store_true",
+    help="print the predictions as JSON",
+  )
+  args = parser.parse_args(argv)
+
+  patches_config = json.load(args.patches_config)
+  if args.repo:
+    patches_config = [t for t in patches_config if t.get('repo') in args.repo]
+  index = PatchIndex(
+    args.index_file
+    or default_index_path(os.path.dirname(args.patches_config.name))
+  )
+
+  report = []
+  for target, commit, predictions in predict_config(
+      patches_config, index, args.ref):
+    if args.json:
+      report.append({
+        'repo': target.get('repo'),
+        'patch_dir': target.get('patch_dir'),
+        'commit': commit,
+        'patches': [
+          {
+            'patch': patch_filename,
+            'status': status,
+            'files': [
+              {'path': path, 'status': file_status, 'moved_to': detail}
+              for path, file_status, detail in conflicts
+            ],
+          }
+          for patch_filename, status, conflicts in predictions
+        ],
+      })
+    else:
+      print_predictions(target, commit, predictions)
+  index.save()
+
+  if args.json:
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
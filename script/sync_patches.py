@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""Apply Electron patches and restore the mtimes of unchanged files, repo by
+repo.
+
+This replaces running apply_all_patches.py, 'patches-mtime-cache.py apply'
+and 'patches-mtime-cache.py restore' one after the other. A repo's mtimes
+are restored as soon as it has been patched, while later repos are still
+being patched. Nothing else overlaps: the cache and snapshot are written
+beforehand by 'patches-mtime-cache.py generate' and 'snapshot'.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import time
+import traceback
+
+from apply_all_patches import apply_patches_logged
+from lib import git
+from lib.mtime_cache import apply_mtimes, digest_file_path, find_cache_file, \
+                            read_cache, restore_times, save_digests, \
+                            split_by_repo
+
+
+def load_optional(path):
+  """Load the mtime cache or snapshot at |path|, or an earlier version's
+  JSON cache next to it. Returns (path, entries); a cache that is missing or
+  unreadable just means there are no mtimes to restore."""
+  if path is None:
+    return None, None
+  existing = find_cache_file(path)
+  if existing is None:
+    return None, None
+  try:
+    return existing, read_cache(existing)
+  except Exception:  # pylint: disable=broad-except
+    print(f'ERROR: failed to read {existing}', file=sys.stderr)
+    traceback.print_exc(file=sys.stderr)
+    return None, None
+
+
+def restore_repo(target, mtime_cache, snapshot, preserve):
+  """Restore the mtimes in one freshly patched repo. Returns the digests for
+  the next 'generate' and the time taken."""
+  started = time.monotonic()
+  digests = {}
+  try:
+    if mtime_cache:
+      digests = apply_mtimes(mtime_cache)
+    if snapshot is not None:
+      restore_times([target], snapshot, preserve_refs=preserve)
+  except Exception:  # pylint: disable=broad-except
+    # Like the mtime cache hooks, never fail the sync over mtimes.
+    print(f"ERROR: failed to restore mtimes in {target['repo']}",
+          file=sys.stderr)
+    traceback.print_exc(file=sys.stderr)
+  return digests, time.monotonic() - started
+
+
+def patch_repo(target, restorer, mtime_cache, snapshot, preserve, cache,
+               engine):
+  """Patch one repo and queue the restoring of its mtimes on |restorer|, so
+  that this worker can go on to patch the next repo. Returns (log, error,
+  seconds, restore_future)."""
+  started = time.monotonic()
+  log, error = apply_patches_logged(target, None, cache, engine)
+  seconds = time.monotonic() - started
+  restore_future = None
+  if error is None and (mtime_cache or snapshot is not None):
+    restore_future = restorer.submit(restore_repo, target, mtime_cache,
+                                     snapshot, preserve)
+  return log, error, seconds, restore_future
+
+
+def sync(config, mtime_cache, snapshot, preserve=False, jobs=1, cache=False,
+         engine='am'):
+  """Patch every target in |config|, at most |jobs| at a time, restoring the
+  mtimes in each repo once it is patched. Returns (failures, digests,
+  timings), where |timings| holds (target, patch_seconds,
+  restore_seconds) for every target."""
+  by_repo = split_by_repo(mtime_cache or {}, [t['repo'] for t in config])
+  failures = []
+  digests = {}
+  timings = []
+  with ThreadPoolExecutor(max_workers=jobs) as patchers, \
+       ThreadPoolExecutor(max_workers=1) as restorer:
+    futures = [
+      (target, patchers.submit(patch_repo, target, restorer,
+                               by_repo[target['repo']], snapshot, preserve,
+                               cache, engine))
+      for target in config
+    ]
+    restores = []
+    for target, future in futures:
+      log, error, seconds, restore_future = future.result()
+      status = 'FAILED' if error is not None else 'done'
+      sys.stdout.write(f"==> {target['repo']}: {status}\n{log}")
+      sys.stdout.flush()
+      if error is not None:
+        failures.append((target, error))
+      restores.append((target, seconds, restore_future))
+    for target, seconds, restore_future in restores:
+      restore_seconds = None
+      if restore_future is not None:
+        repo_digests, restore_seconds = restore_future.result()
+        digests.update(repo_digests)
+      timings.append((target, seconds, restore_seconds))
+  return failures, digests, timings
+
+
+def print_timings(load_seconds, timings, total_seconds):
+  print('Timing:')
+  print(f'  {load_seconds:8.2f}s  read config, mtime cache and snapshot')
+  busy = load_seconds
+  for target, patch_seconds, restore_seconds in timings:
+    print(f"  {patch_seconds:8.2f}s  patch {target['repo']}")
+    busy += patch_seconds
+    if restore_seconds is not None:
+      print(f"  {restore_seconds:8.2f}s  restore mtimes in {target['repo']}")
+      busy += restore_seconds
+  print(f'  {total_seconds:8.2f}s  total, {max(busy - total_seconds, 0):.2f}s '
+        f'of it overlapped')
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('config', type=argparse.FileType('r'),
+                      help='patches\' config in the JSON format')
+  parser.add_argument('--cache-file',
+                      help='mtime cache written by \'patches-mtime-cache.py '
+                           'generate\'. Ignored if it does not exist.')
+  parser.add_argument('--snapshot-file',
+                      help='snapshot written by \'patches-mtime-cache.py '
+                           'snapshot\'. Ignored if it does not exist.')
+  parser.add_argument('--preserve-cache', action='store_true',
+                      help='don\'t delete the mtime cache and snapshot '
+                           'afterwards')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='number of repos to patch concurrently. Pass 0 '
+                           'to use one worker per repo.')
+  parser.add_argument('--cache', action='store_true',
+                      help='reuse the previously patched commit when neither '
+                           'the upstream HEAD nor the patch series changed')
+  parser.add_argument('--engine', choices=list(git.IMPORT_ENGINES),
+                      default='am',
+                      help='how to create the patch commits')
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+  started = time.monotonic()
+  config = json.load(args.config)
+  cache_file, mtime_cache = load_optional(args.cache_file)
+  snapshot_file, snapshot = load_optional(args.snapshot_file)
+  load_seconds = time.monotonic() - started
+
+  jobs = args.jobs if args.jobs > 0 else max(len(config), 1)
+  failures, digests, timings = sync(config, mtime_cache, snapshot,
+                                    args.preserve_cache, jobs, args.cache,
+                                    args.engine)
+  print_timings(load_seconds, timings, time.monotonic() - started)
+
+  if failures:
+    sys.stderr.write(
+      f"Failed to apply patches in {len(failures)} of {len(config)} repos:\n"
+    )
+    for target, error in failures:
+      sys.stderr.write(
+        f"-- {target.get('repo')} ({target.get('patch_dir')}): {error}\n"
+      )
+    # Keep the mtime cache and snapshot for the next attempt.
+    sys.exit(1)
+
+  if cache_file is not None:
+    save_digests(digest_file_path(args.cache_file), digests)
+  if not args.preserve_cache:
+    for path in (cache_file, snapshot_file):
+      if path is not None:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+  main()
@@ -24,7 +24,7 @@ def main():
   with scoped_cwd(args.build_dir):
     dirs = ['breakpad_symbols']
     print('Making symbol zip: ' + zip_file)
-    make_zip(zip_file, licenses, dirs)
+    make_zip(zip_file, licenses, dirs, deterministic=True)
 
   if PLATFORM == 'darwin':
     dsym_name = 'dsym.zip'
@@ -36,11 +36,12 @@ def main():
           dsyms.remove(dsym)
       dsym_zip_file = os.path.join(args.build_dir, dsym_name)
       print('Making dsym zip: ' + dsym_zip_file)
-      make_zip(dsym_zip_file, licenses, dsyms)
+      make_zip(dsym_zip_file, licenses, dsyms, deterministic=True)
       dsym_snapshot_name = 'dsym-snapshot.zip'
       dsym_snapshot_zip_file = os.path.join(args.build_dir, dsym_snapshot_name)
       print('Making dsym snapshot zip: ' + dsym_snapshot_zip_file)
-      make_zip(dsym_snapshot_zip_file, licenses, snapshot_dsyms)
+      make_zip(dsym_snapshot_zip_file, licenses, snapshot_dsyms,
+               deterministic=True)
       if len(dsyms) > 0 and 'DELETE_DSYMS_AFTER_ZIP' in os.environ:
         execute(['rm', '-rf'] + dsyms)
   elif PLATFORM == 'win32':
@@ -49,14 +50,14 @@ def main():
       pdbs = glob.glob('*.pdb')
       pdb_zip_file = os.path.join(args.build_dir, pdb_name)
       print('Making pdb zip: ' + pdb_zip_file)
-      make_zip(pdb_zip_file, pdbs + licenses, [])
+      make_zip(pdb_zip_file, pdbs + licenses, [], deterministic=True)
   elif PLATFORM == 'linux':
     debug_name = 'debug.zip'
     with scoped_cwd(args.build_dir):
       dirs = ['debug']
       debug_zip_file = os.path.join(args.build_dir, debug_name)
       print('Making debug zip: ' + debug_zip_file)
-      make_zip(debug_zip_file, licenses, dirs)
+      make_zip(debug_zip_file, licenses, dirs, deterministic=True)
 
 def parse_args():
   parser = argparse.ArgumentParser(description='Zip symbols')